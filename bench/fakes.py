@@ -0,0 +1,290 @@
+"""Stand-ins for Discord and youtube-dl, just enough for the Music cog.
+
+Nothing here talks to the network: messages are objects in memory, voice
+clients read 20 ms frames from a single clock task instead of sending
+them, and extraction sleeps for a synthetic delay and writes a short raw
+PCM file into the downloads folder.
+"""
+import asyncio
+import collections
+import hashlib
+import itertools
+import os
+import random
+import time
+
+FRAME_BYTES = 3840  # 20ms of 48kHz 16-bit stereo
+_ids = itertools.count(1000)
+
+
+class Api:
+    """Counts the Discord calls the bot makes and optionally delays them."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+
+    async def call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeMessage:
+    def __init__(self, api, channel, content=None, embed=None):
+        self.api = api
+        self.id = next(_ids)
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.author = channel.guild.me
+
+    async def add_reaction(self, emoji):
+        await self.api.call('add_reaction')
+
+    async def edit(self, *, content=None, embed=None):
+        await self.api.call('edit')
+        self.content = content if content is not None else self.content
+        self.embed = embed if embed is not None else self.embed
+
+    async def delete(self):
+        await self.api.call('delete')
+
+
+class FakeChannel:
+    def __init__(self, api, guild):
+        self.api = api
+        self.id = next(_ids)
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, content=None, *, embed=None, delete_after=None):
+        await self.api.call('send')
+        self.sent += 1
+        return FakeMessage(self.api, self, content, embed)
+
+    async def purge(self, *, check=None, limit=100):
+        await self.api.call('purge')
+
+    async def trigger_typing(self):
+        await self.api.call('typing')
+
+
+class Speaker:
+    """Plays every fake voice client from one clock, like the voice threads would.
+
+    Each tick reads one frame from every playing source, so the cost of the
+    audio path (volume scaling and so on) is part of the benchmark, and
+    records how long each client went without audio between two songs:
+    between two play() calls, or at a switch inside a Mixer, which reports
+    its own gap (negative while two songs crossfade).
+    """
+
+    def __init__(self):
+        self.playing = set()
+        self.frames = 0
+        self.gaps = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        next_tick = time.perf_counter()
+        while True:
+            for client in list(self.playing):
+                if client.paused:
+                    continue
+                source = client.source
+                data = source.read()
+                self.frames += 1
+                switches = getattr(source, 'switches', None)
+                if switches is not None and switches != client.switches:
+                    client.switches = switches
+                    self.gaps.append(source.last_gap)
+                if len(data) < FRAME_BYTES:
+                    client.finish()
+            next_tick += 0.02
+            await asyncio.sleep(max(0.0, next_tick - time.perf_counter()))
+
+
+class FakeVoiceClient:
+    def __init__(self, speaker, guild, channel):
+        self.speaker = speaker
+        self.guild = guild
+        self.channel = channel
+        self.source = None
+        self.paused = False
+        self.ended = None
+        self.switches = 0
+        self._after = None
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self.source is not None and not self.paused
+
+    def is_paused(self):
+        return self.source is not None and self.paused
+
+    def play(self, source, *, after=None):
+        if self.ended is not None:
+            self.speaker.gaps.append(time.perf_counter() - self.ended)
+            self.ended = None
+        self.source = source
+        self.switches = 0
+        self.paused = False
+        self._after = after
+        self.speaker.playing.add(self)
+
+    def finish(self):
+        # 跟 discord.py 的 AudioPlayer 一樣，停下來的 source 都會 cleanup()
+        self.speaker.playing.discard(self)
+        self.source.cleanup()
+        self.source = None
+        self.ended = time.perf_counter()
+        after, self._after = self._after, None
+        if after is not None:
+            after(None)
+
+    def stop(self):
+        if self.source is not None:
+            self.finish()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self):
+        self.stop()
+        self.ended = None
+        self.guild.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, speaker, guild):
+        self.speaker = speaker
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = f'voice-{self.id}'
+
+    def __str__(self):
+        return self.name
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self.speaker, self.guild, self)
+        return self.guild.voice_client
+
+
+class FakeMember:
+    bot = False
+
+    def __init__(self, guild, voice_channel, name):
+        self.id = next(_ids)
+        self.guild = guild
+        self.display_name = name
+        self.voice = type('VoiceState', (), {'channel': voice_channel})()
+
+
+class FakeGuild:
+    def __init__(self, api, speaker):
+        self.id = next(_ids)
+        self.voice_client = None
+        self.me = FakeMember(self, None, 'bot')
+        self.text_channel = FakeChannel(api, self)
+        self.voice_channel = FakeVoiceChannel(speaker, self)
+        self.members = [FakeMember(self, self.voice_channel, f'user{i}') for i in range(3)]
+
+
+class FakeBot:
+    def __init__(self, api):
+        self.api = api
+        self.loop = asyncio.get_event_loop()
+        self.user = type('User', (), {'id': 1})()
+        self.latency = 0.0
+
+    async def wait_until_ready(self):
+        pass
+
+    def is_closed(self):
+        return False
+
+
+class FakeContext:
+    """What a command sees as ctx."""
+
+    def __init__(self, bot, cog, guild, author):
+        self.bot = bot
+        self.cog = cog
+        self.guild = guild
+        self.author = author
+        self.channel = guild.text_channel
+        self.command = None
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, *, embed=None, delete_after=None):
+        return await self.channel.send(content, embed=embed, delete_after=delete_after)
+
+    async def trigger_typing(self):
+        await self.channel.trigger_typing()
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command.callback(self.cog, self, *args, **kwargs)
+
+
+class StubExtraction:
+    """Looks like ExtractionPool: sleeps instead of running youtube-dl.
+
+    *workers* jobs run at once, like the real pool, and each one takes a
+    random time between *delay*. Downloads are a *seconds* long file of
+    silence in raw PCM.
+    """
+
+    def __init__(self, directory, *, workers=3, delay=(0.05, 0.3), seconds=0.5):
+        self.directory = directory
+        self.workers = workers
+        self.delay = delay
+        self.audio = bytes(int(seconds * 50) * FRAME_BYTES)
+        self._slots = asyncio.Semaphore(workers)
+        self.waiting = 0
+        self.busy = 0
+        self.done = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    async def extract(self, search, *, download=True, timeout=None):
+        song_id = hashlib.sha1(search.encode('utf8')).hexdigest()[:11]
+        self.waiting += 1
+        async with self._slots:
+            self.waiting -= 1
+            self.busy += 1
+            try:
+                await asyncio.sleep(random.uniform(*self.delay))
+                file_url = os.path.join(self.directory, f'stub-{song_id}.pcm')
+                if download and not os.path.exists(file_url):
+                    os.makedirs(self.directory, exist_ok=True)
+                    with open(file_url, 'wb') as f:
+                        f.write(self.audio)
+            finally:
+                self.busy -= 1
+        self.done += 1
+        info = {'id': song_id, 'title': f'song {search}', 'webpage_url': f'stub://{song_id}',
+                'extractor': 'stub', 'ext': 'pcm', 'duration': len(self.audio) / FRAME_BYTES / 50}
+        return info, file_url
+
+    def stats(self):
+        return {'workers': self.workers, 'busy': self.busy, 'waiting': self.waiting,
+                'done': self.done, 'failed': self.failed, 'timeouts': self.timeouts}
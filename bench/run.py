@@ -0,0 +1,211 @@
+"""Offline benchmark of the Music cog at 1, 10, 100 and 1000 guilds.
+
+    python bench/run.py            # every size
+    python bench/run.py 1 10       # only these sizes
+
+Each size runs in a fresh temporary folder with a seeded song.json. Every
+guild connects, asks for PLAYS songs with !play (stub youtube-dl), fills
+the queue with !pl, looks at !queue and changes the volume; then the
+songs play out against the fake voice clients. Then a second, quiet pass
+measures memory with tracemalloc, because tracing slows everything down.
+
+FFmpeg is not part of this: sources read the stub's raw PCM files directly,
+so the numbers are about the bot itself.
+"""
+import asyncio
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+
+import bot as app  # noqa: E402
+from bench.fakes import Api, FakeBot, FakeContext, FakeGuild, Speaker, StubExtraction  # noqa: E402
+from cache import AudioCache, InfoCache  # noqa: E402
+from history import PlayHistory  # noqa: E402
+from library import LOAD_SECONDS, SAVE_SECONDS, open_library  # noqa: E402
+from loudness import Loudness  # noqa: E402
+from metrics import REGISTRY  # noqa: E402
+from sampler import SongSampler  # noqa: E402
+from snapshot import PlayerStore  # noqa: E402
+from titleindex import TitleIndex  # noqa: E402
+
+SIZES = (1, 10, 100, 1000)
+SEED_SONGS = 2000
+SEED_FILES = 50
+PLAYS = 1
+PLAYLIST_SONGS = 5
+SONG_SECONDS = 0.5
+DRAIN_TIMEOUT = 300
+
+
+async def regather_stream(cls, data, *, loop, volume=None):
+    # 不跑 FFmpeg，直接讀 stub 寫的 PCM 檔
+    with open(data['file_url'], 'rb') as f:
+        pcm = f.read()
+    return cls(discord.PCMAudio(io.BytesIO(pcm)), data=data, requester=data['requester'])
+
+
+def seed_library(path, extraction):
+    """A song.json with SEED_SONGS songs that are already downloaded."""
+    os.makedirs(extraction.directory, exist_ok=True)
+    for i in range(SEED_FILES):
+        with open(os.path.join(extraction.directory, f'seed-{i}.pcm'), 'wb') as f:
+            f.write(extraction.audio)
+    library = open_library(path)
+    for i in range(SEED_SONGS):
+        library.add(f'seed{i}', {'title': f'seed song {i}', 'url': f'seed {i}', 'requester': 'bench',
+                                 'file_url': os.path.join(extraction.directory, f'seed-{i % SEED_FILES}.pcm')})
+    library.close()
+
+
+def install(api):
+    """Point bot.py's globals at fresh state in the current folder and return (bot, cog)."""
+    app.OPUS_PASSTHROUGH = False
+    app.extraction = StubExtraction('downloads', workers=app.EXTRACT_WORKERS, seconds=SONG_SECONDS)
+    seed_library('song.json', app.extraction)
+    REGISTRY.reset()
+    app.library = open_library('song.json')
+    app.sampler = SongSampler(app.library, recent=app.RECENT_SONGS).load()
+    app.title_index = TitleIndex(app.library).load()
+    app.history = PlayHistory('history.jsonl')
+    app.player_store = PlayerStore('players.json', app.library).load()
+    app.audio_cache = AudioCache('downloads', budget=app.CACHE_BUDGET, policy=app.CACHE_POLICY).load()
+    app.info_cache = InfoCache('info_cache.json', ttl=24 * 3600)
+    app.loudness = Loudness('loudness.json', target=-16.0, true_peak=-1.5)
+    app.loudness.submit = lambda file_url: None
+    app.YTDLSource.regather_stream = classmethod(regather_stream)
+    fake_bot = FakeBot(api)
+    cog = app.Music(fake_bot)
+    app.Main_bot = cog
+    app.audio_cache.pinned = cog.pinned_files
+    return fake_bot, cog
+
+
+async def run_commands(fake_bot, cog, guild, latencies):
+    ctx = FakeContext(fake_bot, cog, guild, guild.members[0])
+    commands = [(cog.connect_, {})]
+    commands += [(cog.play_, {'search': f'{guild.id} {i}'}) for i in range(PLAYS)]
+    commands += [(cog.playlist_, {'inputstr': str(PLAYLIST_SONGS)}),
+                 (cog.queue_info, {}),
+                 (cog.change_volume, {'vol': 30.0})]
+    for command, kwargs in commands:
+        start = time.perf_counter()
+        await command.callback(cog, ctx, **kwargs)
+        latencies.setdefault(command.name, []).append(time.perf_counter() - start)
+
+
+def busy(cog):
+    return any(player.current is not None or not player.queue.empty() for player in cog.players.values())
+
+
+async def teardown(cog, guilds):
+    for guild in guilds:
+        await cog.cleanup(guild)
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    await asyncio.sleep(0)
+    # 存檔的計時器也要停掉，不然會在下一輪的資料夾裡寫檔
+    app.player_store.close()
+    app.library.close()
+    app.history.close()
+    app.audio_cache.close()
+    app.info_cache.close()
+
+
+def quantiles(values):
+    if len(values) < 2:
+        return (values[0], values[0]) if values else (float('nan'), float('nan'))
+    cuts = statistics.quantiles(values, n=20)
+    return cuts[9], cuts[18]
+
+
+async def timed_run(size):
+    api = Api()
+    fake_bot, cog = install(api)
+    speaker = Speaker()
+    speaker.start()
+    guilds = [FakeGuild(api, speaker) for _ in range(size)]
+    latencies = {}
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_commands(fake_bot, cog, guild, latencies) for guild in guilds))
+    command_seconds = time.perf_counter() - start
+    commands = sum(len(values) for values in latencies.values())
+
+    deadline = time.perf_counter() + DRAIN_TIMEOUT
+    while busy(cog) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+    drained = not busy(cog)
+
+    await app.library.flush()
+    speaker.stop()
+    await teardown(cog, guilds)
+
+    songs = app.SONGS_PLAYED.value(mode='pcm')
+    return {
+        'commands/s': commands / command_seconds,
+        'enqueue': quantiles(latencies['play']),
+        'gap': quantiles(speaker.gaps),
+        'songs': songs,
+        'drained': drained,
+        'api/song': sum(api.calls.values()) / max(songs, 1),
+        'load': LOAD_SECONDS.quantile(.5, backend='json'),
+        'save': SAVE_SECONDS.quantile(.5, backend='json'),
+    }
+
+
+async def memory_run(size):
+    api = Api()
+    fake_bot, cog = install(api)
+    speaker = Speaker()
+    guilds = [FakeGuild(api, speaker) for _ in range(size)]
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for guild in guilds:
+        ctx = FakeContext(fake_bot, cog, guild, guild.members[0])
+        await cog.connect_.callback(cog, ctx)
+        await cog.playlist_.callback(cog, ctx, inputstr='20')
+    await asyncio.sleep(0.1)
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    await teardown(cog, guilds)
+    return used / size
+
+
+def main(sizes):
+    loop = asyncio.get_event_loop()
+    here = os.getcwd()
+    print(f'{"guilds":>6} {"cmd/s":>8} {"enqueue p50/p95 ms":>19} {"gap p50/p95 ms":>15} '
+          f'{"songs":>6} {"api/song":>8} {"load ms":>8} {"save ms":>8} {"KiB/guild":>9}')
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                result = loop.run_until_complete(timed_run(size))
+            finally:
+                os.chdir(here)
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                per_guild = loop.run_until_complete(memory_run(size))
+            finally:
+                os.chdir(here)
+        enqueue = '/'.join(f'{value * 1000:.0f}' for value in result['enqueue'])
+        gap = '/'.join(f'{value * 1000:.0f}' for value in result['gap'])
+        songs = f'{result["songs"]}' + ('' if result['drained'] else '*')
+        print(f'{size:>6} {result["commands/s"]:>8.1f} {enqueue:>19} {gap:>15} {songs:>6} '
+              f'{result["api/song"]:>8.1f} {(result["load"] or 0) * 1000:>8.1f} {(result["save"] or 0) * 1000:>8.1f} '
+              f'{per_guild / 1024:>9.1f}')
+    print('* = the queues did not finish playing within the timeout')
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or SIZES)
@@ -1,36 +1,155 @@
 import discord
 from discord.ext import commands
 import asyncio
-import itertools
+import collections
+import re
 import sys
 import traceback
 from async_timeout import timeout
-from functools import partial
-from youtube_dl import YoutubeDL
 import kkbox
-import random
-import json
 from datetime import datetime
-
-ytdlopts = {
-    'format': 'bestaudio/best',
-    'outtmpl': 'downloads/%(extractor)s-%(id)s.%(ext)s',
-    'restrictfilenames': True,
-    'noplaylist': True,
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'geo-bypass': True,
-    'no_warnings': False,
-    'default_search': 'auto',
-    'cachedir': False,
-}
+import os
+import time
+from aiohttp import web
+from library import open_library
+from cache import AudioCache, InfoCache
+from loudness import Loudness, OpusVariants
+from extractor import ExtractionPool
+from playqueue import FORCE, PlayQueue, SCHEDULERS
+from sampler import SongSampler
+from history import PlayHistory
+from titleindex import TitleIndex
+from panel import Panel, RateLimiter
+from controls import Controls
+from metrics import REGISTRY, Counter, Gauge, Histogram
+from snapshot import PlayerStore
+from mixer import Mixer
+from dsp import NUMPY, PCMStage
+
+# launcher.py 用環境變數告訴每個 worker 負責哪些 shard，直接跑 bot.py 就是一個 process 全包
+SHARD_COUNT = int(os.environ['BOT_SHARD_COUNT']) if os.environ.get('BOT_SHARD_COUNT') else None
+SHARD_IDS = [int(shard) for shard in os.environ['BOT_SHARD_IDS'].split(',')] if os.environ.get('BOT_SHARD_IDS') else None
+WORKER_ID = os.environ.get('BOT_WORKER_ID')
+WORKERS = int(os.environ.get('BOT_WORKERS', 1))
+
+
+def state_path(name):
+    """This worker's copy of a state file. Only song.db is shared between workers."""
+    if WORKER_ID is None:
+        return name
+    base, ext = os.path.splitext(name)
+    return f'{base}.{WORKER_ID}{ext}'
+
+
+DOWNLOAD_DIR = state_path('downloads')
 Downloaded_ffmpegopts = {
     'before_options': '-nostdin',
     'options': '-vn -af loudnorm=I=-16:TP=-1.5:LRA=11'
 }
-ytdl = YoutubeDL(ytdlopts)
+# 已經量過響度的歌只要調整音量，不用即時跑 loudnorm
+Gain_ffmpegopts = {
+    'before_options': '-nostdin',
+    'options': '-vn -af volume={gain}dB'
+}
+# youtube-dl 在獨立的 process 裡跑，卡住的工作超過時間就砍掉
+EXTRACT_WORKERS = 3
+EXTRACT_TIMEOUT = 120
+extraction = None
+YOUTUBE_ID = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/)|youtu\.be/)([\w-]{11})')
+# !add 同時下載幾首歌
+ADD_CONCURRENCY = 4
+# 播放時先確認佇列裡接下來幾首歌已經下載好
+LOOKAHEAD = 3
+# 佇列排序方式: strict (照優先度), rr (點歌的人輪流), wfq (加權公平)
+DEFAULT_SCHEDULER = 'strict'
+# downloads/ 最多用多少空間，超過就刪最久沒播的歌 (lru) 或最少播的歌 (lfu)，多個 worker 平分
+CACHE_BUDGET = 5 * 1024 ** 3
+CACHE_POLICY = 'lru'
+audio_cache = None
+# 搜尋字串/網址 -> 歌曲資訊，同一首歌不用每次都問 YouTube
+info_cache = None
+loudness = None
+# 無縫接歌: 一首快播完時先把下一首的 FFmpeg 開好，最後 CROSSFADE_SECONDS 秒兩首疊在一起 (0 就是直接接上)
+GAPLESS = True
+MIXER_BUFFER_SECONDS = 1.0
+CROSSFADE_SECONDS = 0.5
+# 事先轉好音量的 Opus 檔可以直接送給 Discord，不用在 bot 裡解碼/調音量/編碼
+# (FFmpegOpusAudio 要 discord.py 1.4 以上)
+# 每首歌各自決定: Opus 版本轉好了就直送，不然走 PCM 進 mixer。直送的歌不能和別首混，前後是硬切
+OPUS_PASSTHROUGH = hasattr(discord, 'FFmpegOpusAudio')
+# 音量只轉固定幾階 (OpusVariants.LEVELS)，每首最多 3 個版本
+opus_variants = OpusVariants(bitrate=128, limit=3)
+# 有 numpy 的話 mixer 一次處理 PCM_BLOCK 格 (一格 20ms): 音量漸變不會爆音，可以加低音 (dB) 和限幅 (滿格的比例，None 是關掉)
+# PCM_BLOCK 至少要 5，一次一格的話 numpy 比 audioop 還慢 (bench/pcm.py: 18.0 vs 14.3 µs/格)
+PCM_BLOCK = 5
+BASS_BOOST = 0.0
+LIMITER = None
+# 自定義歌單，啟動時讀一次，之後都從記憶體查
+# 用 python library.py song.json song.db 轉成 SQLite 之後就會改用 song.db
+LIBRARY_PATH = 'song.db' if os.path.exists('song.db') else 'song.json'
+library = None
+# 多個 worker 共用 song.db，每幾秒看一下別的 worker 有沒有改歌單
+LIBRARY_REFRESH = 5
+# 歌名模糊搜尋 (!pl find)
+title_index = None
+# !pl list 一頁幾首，按鈕多久沒人按就不理了
+PAGE_SIZE = 20
+PAGE_TIMEOUT = 180
+PAGE_BUTTONS = ('⏪', '◀️', '▶️', '⏩')
+# 正在播放的訊息每個 guild 只有一則，按鈕只加一次，之後都用編輯的
+PANEL_BUTTONS = ('⏯️', '⏭️', '⏹️', '🔊', '🔉', '📃', '🎵')
+discord_limits = RateLimiter()
+# 按鈕的反應先收集一小段時間再一起處理
+REACTION_DEBOUNCE = 0.75
+controls = Controls(REACTION_DEBOUNCE)
+# 隨機選歌 (auto() 和 !pl <n>)，每個伺服器最近播過的幾首歌先跳過
+RECENT_SONGS = 100
+# 隨機選歌時常播的歌比較容易被選到 (但剛播過的比較不會)，抽到的首數跟沒加權一樣 (見 tests/test_sampler.py)
+WEIGHTED_SAMPLING = True
+sampler = None
+history = None
+# 重開之後接著播: 每個伺服器的佇列、正在播的歌和音量存在 players.json，回到語音頻道時才恢復
+PLAYERS_PATH = state_path('players.json')
+player_store = None
+# 重開之後先在背景把存起來的佇列最前面幾首下載好，一次一首，不要一起塞爆 youtube-dl
+PREWARM_CONCURRENCY = 1
+# 效能數據: http://127.0.0.1:9108/metrics (第 N 個 worker 是 9108+N)，!debug perf 也看得到
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108 + int(WORKER_ID or 0)
+CREATE_SOURCE_SECONDS = Histogram('music_create_source_seconds', 'Time from a search to a downloaded song, cache hits included')
+EXTRACT_SECONDS = Histogram('music_extract_seconds', 'youtube-dl time for one song', ['download'])
+FFMPEG_START_SECONDS = Histogram('music_ffmpeg_start_seconds', 'Time to start FFmpeg for a song', ['mode'])
+TRACK_GAP_SECONDS = Histogram('music_track_gap_seconds', 'Silence between a song and the next queued one')
+DISCORD_SECONDS = Histogram('discord_api_seconds', 'Discord REST call latency, rate limit waits included',
+                            ['method', 'route'])
+PLAYER_ERRORS = Counter('music_player_errors_total', 'Queued songs that could not be played')
+SONGS_PLAYED = Counter('music_songs_played_total', 'Songs started', ['mode'])
+Counter('music_info_cache_hits_total', 'Searches answered from the info cache', function=lambda: info_cache.hits)
+Counter('music_info_cache_misses_total', 'Searches that needed youtube-dl', function=lambda: info_cache.misses)
+Counter('music_extract_failed_total', 'youtube-dl jobs that failed', function=lambda: extraction.failed)
+Counter('music_extract_timeouts_total', 'youtube-dl jobs that were killed', function=lambda: extraction.timeouts)
+Gauge('music_extract_busy', 'youtube-dl workers working', function=lambda: extraction.busy)
+Gauge('music_extract_waiting', 'youtube-dl jobs waiting for a worker', function=lambda: extraction.waiting)
+Gauge('music_cache_bytes', 'Size of the downloads folder', function=lambda: audio_cache.total)
+Gauge('music_players', 'Guilds with a player', function=lambda: len(Main_bot.players))
+Gauge('music_player_bytes', 'Rough memory held by all players and their queues',
+      function=lambda: sum(player.memory() for player in Main_bot.players.values()))
+Gauge('music_suspended_players', 'Guilds whose queue waits on disk for the bot to come back',
+      function=lambda: len(player_store.saved))
+Gauge('music_queued_songs', 'Songs waiting in all queues',
+      function=lambda: sum(len(player.queue) for player in Main_bot.players.values()))
+Gauge('discord_gateway_latency_seconds', 'Heartbeat latency', function=lambda: bot.latency)
+
+
+def approx_size(obj, depth=3):
+    """sys.getsizeof() plus what dicts, lists and tuples hold, a few levels down."""
+    size = sys.getsizeof(obj)
+    if depth:
+        if isinstance(obj, dict):
+            size += sum(approx_size(key, depth - 1) + approx_size(value, depth - 1) for key, value in obj.items())
+        elif isinstance(obj, (list, tuple, set)):
+            size += sum(approx_size(item, depth - 1) for item in obj)
+    return size
 
 
 class VoiceConnectionError(commands.CommandError):
@@ -42,11 +161,16 @@ class InvalidVoiceChannel(VoiceConnectionError):
 
 
 class YTDLSource(discord.PCMVolumeTransformer):
+    # 正在跑的 youtube-dl 工作，同一首歌同時被點很多次只跑一次
+    _flights = {}
+
     def __init__(self, source, *, data, requester):
         super().__init__(source)
         self.requester = requester
         self.title = data.get('title')
         self.web_url = data.get('webpage_url')
+        self.file_url = data.get('file_url')
+        self.id = data.get('id')
 
         # YTDL info dicts (data) have other useful information you might want
         # https://github.com/rg3/youtube-dl/blob/master/README.md
@@ -59,26 +183,153 @@ class YTDLSource(discord.PCMVolumeTransformer):
         return self.__getattribute__(item)
 
     @classmethod
-    async def create_source(cls, ctx, search: str, *, loop, islist=False):
+    async def extract(cls, search, *, loop, download=True):
+        """Run youtube-dl on *search* and return (info dict, local file name).
+
+        Results are cached, so asking for the same search or URL again is free.
+        With download=False only the metadata (id, title, url...) is looked up
+        and nothing is written to downloads/. Concurrent calls for the same song
+        share one youtube-dl job; two text searches that turn out to be the same
+        video each download to a temporary name and the finished file replaces
+        the other, so a file that is playing is never half written.
+        """
         loop = loop or asyncio.get_event_loop()
-        to_run = partial(ytdl.extract_info, url=search, download=True)
-        data = await loop.run_in_executor(None, to_run)
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
+        cached = info_cache.get(search)
+        if cached is not None:
+            data, file_url = cached
+            if not download or os.path.exists(file_url):
+                return data, file_url
+            # 知道是哪首歌，只是檔案被刪了，直接用網址下載就好
+            url = data['webpage_url']
+            key = 'youtube:' + data['id']
+        else:
+            url = search
+            match = YOUTUBE_ID.search(search)
+            key = 'youtube:' + match.group(1) if match else info_cache.key(search)
+
+        # 只要資訊的話，搭正在下載的那一班也可以
+        flight = cls._flights.get((key, True)) or cls._flights.get((key, download))
+        if flight is None:
+            flight = loop.create_task(cls._extract(search, url, download))
+            cls._flights[key, download] = flight
+            flight.add_done_callback(lambda _: cls._flights.pop((key, download), None))
+        # 一個人取消不能讓其他在等的人也失敗
+        return await asyncio.shield(flight)
+
+    @classmethod
+    async def _extract(cls, search, url, download):
+        with EXTRACT_SECONDS.time(download=download):
+            data, file_url = await extraction.extract(url, download=download)
+        if download:
+            audio_cache.add(file_url, data['id'])
+            loudness.submit(file_url)
+        return info_cache.put(search, data, file_url), file_url
+
+    @classmethod
+    async def create_source(cls, ctx, search: str, *, loop, islist=False):
+        with CREATE_SOURCE_SECONDS.time():
+            data, source = await cls.extract(search, loop=loop)
         if islist is True:
             await ctx.send(f'```ini\n[{ctx.author.display_name} 新增 {data["title"]} 到佇列中]\n```', delete_after=10)
-        source = ytdl.prepare_filename(data)
         return {'id': data['id'], 'webpage_url': data['webpage_url'], 'file_url': source, 'requester': ctx.author.display_name, 'title': data['title']}
 
     @classmethod
-    async def regather_stream(cls, data, *, loop):
+    async def create_sources(cls, ctx, searches, *, loop, limit=ADD_CONCURRENCY):
+        """Resolve and download many searches, at most *limit* at a time.
+
+        Yields (search, source, error) in the original order, each one as soon as it
+        and everything before it is ready, so the first song can start playing
+        while the rest are still downloading.
+        """
+        semaphore = asyncio.Semaphore(limit)
+
+        async def run(search):
+            async with semaphore:
+                return await cls.create_source(ctx, search, loop=loop, islist=True)
+
+        tasks = [loop.create_task(run(search)) for search in searches]
+        try:
+            for search, task in zip(searches, tasks):
+                try:
+                    yield search, await task, None
+                except Exception as e:
+                    yield search, None, e
+        finally:
+            # 指令被取消的話，還沒下載完的也不用下載了
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def local_file(data):
+        """This worker's file for the song *data*, or None if it has to be downloaded."""
+        # song.db 是所有 worker 共用的，裡面的 file_url 可能在別的 worker 的資料夾，要問自己的快取
+        file_url = audio_cache.find(data.get('id'))
+        if file_url is None and data.get('file_url') in audio_cache.entries:
+            file_url = data['file_url']
+        return file_url if file_url is not None and os.path.exists(file_url) else None
+
+    @classmethod
+    async def ensure_local(cls, data, *, loop):
+        """Download a queued song again if its file is gone. Returns the file name."""
+        file_url = cls.local_file(data)
+        if file_url is not None:
+            return file_url
+        _, file_url = await cls.extract(data.get('webpage_url') or data['url'], loop=loop)
+        return file_url
+
+    @classmethod
+    async def regather_stream(cls, data, *, loop, volume=None):
         """Used for preparing a stream, instead of downloading.
 
-        Since Youtube Streaming links expire."""
+        Since Youtube Streaming links expire.
+
+        When *volume* is given and an Opus copy at that volume is ready, the
+        copy is sent to Discord as is instead of going through PCM."""
         loop = loop or asyncio.get_event_loop()
         requester = data['requester']
-        return cls(discord.FFmpegPCMAudio(data['file_url'], **Downloaded_ffmpegopts), data=data, requester=requester)
+        gain = loudness.gain(data['file_url'])
+        if gain is None:
+            loudness.submit(data['file_url'])
+            ffmpegopts = Downloaded_ffmpegopts
+        elif OPUS_PASSTHROUGH and volume is not None:
+            opus_url = opus_variants.get(data['file_url'], volume)
+            if opus_url is not None:
+                return YTDLOpusSource(discord.FFmpegOpusAudio(opus_url, codec='copy', before_options='-nostdin'),
+                                      data=data, requester=requester, volume=volume, opus_url=opus_url)
+            opus_variants.submit(data['file_url'], gain, volume)
+            ffmpegopts = dict(Gain_ffmpegopts, options=Gain_ffmpegopts['options'].format(gain=gain))
+        else:
+            ffmpegopts = dict(Gain_ffmpegopts, options=Gain_ffmpegopts['options'].format(gain=gain))
+        return cls(discord.FFmpegPCMAudio(data['file_url'], **ffmpegopts), data=data, requester=requester)
+
+
+class YTDLOpusSource(discord.AudioSource):
+    """A pre-encoded Opus file sent to Discord without decoding.
+
+    The volume is part of the file, so setting it here only takes effect
+    from the next song.
+    """
+
+    passthrough = True
+
+    def __init__(self, original, *, data, requester, volume, opus_url):
+        self.original = original
+        self.requester = requester
+        self.title = data.get('title')
+        self.web_url = data.get('webpage_url')
+        self.file_url = data.get('file_url')
+        self.id = data.get('id')
+        self.opus_url = opus_url
+        self.volume = volume
+
+    def read(self):
+        return self.original.read()
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.original.cleanup()
 
 
 class MusicPlayer:
@@ -88,10 +339,13 @@ class MusicPlayer:
     simultaneously.
 
     When the bot disconnects from the Voice it's instance will be destroyed.
+    Players only exist while the bot is in a voice channel: if the connection
+    goes away with songs still queued, the player suspends itself into the
+    player store and the next command that brings the bot back rebuilds it.
     """
 
     __slots__ = ('bot', '_guild', '_channel', '_cog',
-                 'queue', 'next', 'current', 'np', 'volume')
+                 'queue', 'next', 'current', 'mixer', 'effects', 'panel', '_volume', 'fetching', 'skipped')
 
     def __init__(self, ctx):
         self.bot = ctx.bot
@@ -99,21 +353,207 @@ class MusicPlayer:
         self._channel = ctx.channel
         self._cog = ctx.cog
 
-        self.queue = asyncio.PriorityQueue()
+        self.queue = PlayQueue(SCHEDULERS[DEFAULT_SCHEDULER]())
+        self.queue.on_change = self._touch
         self.next = asyncio.Event()
 
-        self.np = None  # Now playing message
-        self.volume = .1
+        self.panel = Panel(ctx.channel, PANEL_BUTTONS, limiter=discord_limits)  # Now playing message
+        self.panel.on_change = self._panel_moved
+        self._volume = .1
         self.current = None
+        self.mixer = None  # 無縫接歌時正在播的 Mixer
+        self.effects = None  # 這個 player 的每個 Mixer 共用的 PCMStage，第一次用到才建
+        self.fetching = {}  # song id -> download task
+        self.skipped = False
+        player_store.attach(self._guild.id, self.state)
 
         ctx.bot.loop.create_task(self.player_loop())
 
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        self._touch()
+
+    def _touch(self):
+        player_store.touch(self._guild.id)
+
+    @staticmethod
+    def as_dict(source):
+        """A playing YTDLSource as the dict that queues hold."""
+        return {'id': source.id, 'title': source.title, 'webpage_url': source.web_url,
+                'file_url': source.file_url, 'requester': source.requester}
+
+    def state(self):
+        """What to save so this guild can pick up where it left off after a restart."""
+        items = self.queue.snapshot()
+        staged = self.mixer.next if self.mixer is not None else None
+        if staged is not None:
+            items.insert(0, (FORCE, 0, None, self.as_dict(staged)))
+        if self.current is not None:
+            # 正在播的歌重開之後從頭播
+            items.insert(0, (FORCE, 0, None, self.as_dict(self.current)))
+        if not items:
+            return None
+        return {'volume': self._volume, 'scheduler': self.queue.scheduler.name, 'queue': items}
+
+    def memory(self):
+        """Rough bytes this player holds: itself, its queue and the songs in it."""
+        return (sys.getsizeof(self) + approx_size(self.queue.snapshot())
+                + approx_size(self.fetching) + (sys.getsizeof(self.current) if self.current is not None else 0)
+                + (self.mixer.buffered() if self.mixer is not None else 0))
+
+    def connected(self):
+        vc = self._guild.voice_client
+        return vc is not None and vc.is_connected()
+
+    def restore(self, saved):
+        """Queue what was saved before the restart."""
+        self.volume = saved['volume']
+        if saved['scheduler'] in SCHEDULERS and saved['scheduler'] != self.queue.scheduler.name:
+            self.queue.set_scheduler(SCHEDULERS[saved['scheduler']]())
+        for priority, timestamp, owner, source in saved['queue']:
+            self.queue.put_nowait((priority, timestamp, source), owner=owner)
+        if saved['queue']:
+            self.bot.loop.create_task(self._channel.send(
+                f'```ini\n[恢復重開之前的佇列，共 {len(saved["queue"])} 首]\n```', delete_after=30))
+
+    def _panel_moved(self, old_id, new_id):
+        if old_id is not None:
+            controls.unregister(old_id)
+        if new_id is not None:
+            controls.register(new_id, self._guild.id, panel_clicks)
+
+    def fetch(self, source):
+        """Start downloading *source* in the background if its file is missing.
+
+        Returns the download task, or None when the file is already on disk.
+        """
+        file_url = YTDLSource.local_file(source)
+        if file_url is not None:
+            source['file_url'] = file_url
+            return None
+        key = source.get('id') or source.get('webpage_url') or source['url']
+        task = self.fetching.get(key)
+        if task is None:
+            task = self.bot.loop.create_task(self._fetch(source))
+            self.fetching[key] = task
+            task.add_done_callback(lambda _: self.fetching.pop(key, None))
+        return task
+
+    async def _fetch(self, source):
+        return await YTDLSource.ensure_local(source, loop=self.bot.loop)
+
+    def prefetch(self):
+        """Make sure the next LOOKAHEAD songs in the queue are on local disk."""
+        for _, _, source in self.queue.peek(LOOKAHEAD):
+            if isinstance(source, dict):
+                task = self.fetch(source)
+                if task is not None:
+                    # 錯誤留到真的要播的時候再處理
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                elif OPUS_PASSTHROUGH:
+                    gain = loudness.gain(source['file_url'])
+                    if gain is not None:
+                        opus_variants.submit(source['file_url'], gain, self.volume)
+
+    async def prepare(self, source):
+        """The queued *source* ready to play, or None after telling the channel it can't be."""
+        if isinstance(source, YTDLSource):
+            return source
+        # Source was probably a stream (not downloaded)
+        # So we should regather to prevent stream expiration
+        try:
+            task = self.fetch(source)
+            if task is not None:
+                source['file_url'] = await asyncio.shield(task)
+            start = time.perf_counter()
+            playable = await YTDLSource.regather_stream(source, loop=self.bot.loop, volume=self.volume)
+            FFMPEG_START_SECONDS.observe(time.perf_counter() - start, mode=self.mode(playable))
+        except Exception as e:
+            PLAYER_ERRORS.inc()
+            await self._channel.send(f'There was an error processing your song.\n' f'```css\n[{e}]\n```')
+            await self._channel.send(f'{source}此首歌發生錯誤')
+            print(e)
+            return None
+        return playable
+
+    def start(self, source):
+        """Book keeping for a song that just started. Returns its history event."""
+        self.current = source
+        self._touch()
+        source.volume = self.volume
+        audio_cache.played(source.file_url)
+        if source.id is not None:
+            sampler.played(self._guild.id, source.id)
+        self.skipped = False
+        SONGS_PLAYED.inc(mode=self.mode(source))
+        # 背景更新，不用等 Discord 回應
+        self.panel.show(f'**正在播放:** `{source.title}` 由`{source.requester}`點播')
+        return history.start(self._guild.id, source.id, source.title, source.requester)
+
+    def finish(self, event):
+        """Book keeping for the song that just ended."""
+        source = self.current
+        history.end(event, skipped=self.skipped)
+        # Make sure the FFmpeg process is cleaned up.
+        source.cleanup()
+        if not self.skipped and not self.connected():
+            # 播到一半斷線，下次回來從這首開始
+            self.queue.put_nowait((FORCE, 0, self.as_dict(source)))
+        self.current = None
+        self._touch()
+
+    async def follow(self, event):
+        """The mixer woke us up: it moved on to the staged song, or wants the next one."""
+        mixer = self.mixer
+        if mixer.current is not self.current and mixer.current is not None:
+            # 已經無縫接到下一首了
+            self.finish(event)
+            TRACK_GAP_SECONDS.observe(0.0)
+            event = self.start(mixer.current)
+        if mixer.wants_next and mixer.next is None and not self.queue.empty() and self.connected():
+            if self.passthrough_ready(self.queue.peek(1)[0][2]):
+                # 下一首可以直送 Opus，留在佇列裡: mixer 播完這首就結束，下一首由 player_loop 自己播
+                return event
+            _, _, queued = self.queue.get_nowait()
+            source = await self.prepare(queued)
+            if source is not None:
+                source.volume = self.volume
+                if not mixer.stage(source):
+                    # 準備好的時候已經播完了，放回去給下一輪
+                    self.queue.put_nowait((FORCE, 0, queued if isinstance(queued, dict) else self.as_dict(source)))
+                    source.cleanup()
+            # 準備的時候可能又有事了
+            self.next.set()
+        return event
+
+    def passthrough_ready(self, queued):
+        """True when the queued song will be sent as a ready-made Opus file."""
+        if not OPUS_PASSTHROUGH or not isinstance(queued, dict):
+            return False
+        file_url = YTDLSource.local_file(queued)
+        return file_url is not None and opus_variants.get(file_url, self.volume) is not None
+
+    def skip(self):
+        """Skip the current song; with the mixer the staged one starts right away."""
+        self.skipped = True
+        if self.mixer is not None and self.mixer.skip():
+            return
+        self._guild.voice_client.stop()
+
     async def player_loop(self):
         """Our main player loop."""
         await self.bot.wait_until_ready()
+        ended = None  # 上一首歌結束的時間，佇列裡還有歌的話
 
         while not self.bot.is_closed():
             self.next.clear()
+            if not self.connected():
+                return self.suspend()
 
             try:
                 # Wait for the next song. If we timeout cancel the player and disconnect...
@@ -122,47 +562,65 @@ class MusicPlayer:
                     source = source[2]
             except asyncio.TimeoutError:
                 return self.destroy(self._guild)
-
-            if not isinstance(source, YTDLSource):
-                # Source was probably a stream (not downloaded)
-                # So we should regather to prevent stream expiration
+            if not self.connected():
+                # 等歌的時候被踢出語音頻道了，這首放回最前面
+                self.queue.put_nowait((FORCE, 0, source if isinstance(source, dict) else self.as_dict(source)))
+                return self.suspend()
+
+            source = await self.prepare(source)
+            if source is None:
+                continue
+            event = self.start(source)
+            playing = source
+            if GAPLESS and self.mode(source) == 'pcm':
+                # voice_client.play() 要等上一個語音 thread 不再 read() 才會成功，stage 不會同時被兩邊用
+                if NUMPY and self.effects is None:
+                    self.effects = PCMStage(frames=PCM_BLOCK, volume=self.volume, bass=BASS_BOOST, limiter=LIMITER)
+                # 之後的歌都由 mixer 一首接一首，直到佇列空了或被停掉
+                playing = self.mixer = Mixer(
+                    source, buffer=round(MIXER_BUFFER_SECONDS * 50), crossfade=round(CROSSFADE_SECONDS * 50),
+                    on_event=lambda: self.bot.loop.call_soon_threadsafe(self.next.set), effects=self.effects)
+            self._guild.voice_client.play(
+                playing, after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set))
+            if ended is not None:
+                TRACK_GAP_SECONDS.observe(time.perf_counter() - ended)
+            while True:
+                # 播放途中新加進來的歌也要先下載
+                self.prefetch()
                 try:
-                    source = await YTDLSource.regather_stream(source, loop=self.bot.loop)
-                except Exception as e:
-                    await self._channel.send(f'There was an error processing your song.\n' f'```css\n[{e}]\n```')
-                    await self._channel.send(f'{source}此首歌發生錯誤')
-                    print(e)
+                    await asyncio.wait_for(self.next.wait(), 10)
+                except asyncio.TimeoutError:
                     continue
-            self.current = source
-            source.volume = self.volume
-
-            self._guild.voice_client.play(
-                source, after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set))
-            self.np = await self._channel.send(f'**正在播放:** `{source.title}` 由'
-                                               f'`{source.requester}`點播')
-            await self.np.add_reaction("⏯️")
-            await self.np.add_reaction("⏭️")
-            await self.np.add_reaction("⏹️")
-            await self.np.add_reaction("🔊")
-            await self.np.add_reaction("🔉")
-            await self.np.add_reaction("📃")
-            await self.np.add_reaction("🎵")
-            await self.next.wait()
-
-            # Make sure the FFmpeg process is cleaned up.
-            source.cleanup()
-            self.current = None
-
-            try:
+                self.next.clear()
+                if self.mixer is None or self.mixer.closed:
+                    break
+                event = await self.follow(event)
+
+            self.finish(event)
+            if self.mixer is not None:
+                staged = self.mixer.unstage()
+                if staged is not None:
+                    self.queue.put_nowait((FORCE, 0, self.as_dict(staged)))
+                    staged.cleanup()
+                self.mixer = None
+
+            ended = None if self.queue.empty() else time.perf_counter()
+            if self.queue.empty():
                 # We are no longer playing this song...
-                await self.np.delete()
-            except discord.HTTPException:
-                pass
+                self.panel.show('**播放完畢**，佇列已沒有任何歌曲')
+
+    @staticmethod
+    def mode(source):
+        return 'passthrough' if getattr(source, 'passthrough', False) else 'pcm'
 
     def destroy(self, guild):
         """Disconnect and cleanup the player."""
         return self.bot.loop.create_task(self._cog.cleanup(guild))
 
+    def suspend(self):
+        """Lost the voice connection: put the queue away until the bot is back."""
+        return self.bot.loop.create_task(self._cog.suspend(self))
+
 
 class Music(commands.Cog):
     """Music related commands."""
@@ -174,17 +632,32 @@ class Music(commands.Cog):
         self.players = {}
         self.search_num = 5
         self.welcome = None
+        # (歌單版本, 頁數) -> 畫好的 embed，歌單一改版本就變了
+        self.pages = collections.OrderedDict()
 
     async def cleanup(self, guild):
+        # 先拿掉 player，斷線之後 player_loop 才不會以為是被踢掉而把佇列收起來
+        player = self.players.pop(guild.id, None)
+        if player is not None:
+            player_store.detach(guild.id)
+
         try:
             await guild.voice_client.disconnect()
         except AttributeError:
             pass
 
-        try:
-            del self.players[guild.id]
-        except KeyError:
-            pass
+        if player is not None:
+            await player.panel.close()
+
+    async def suspend(self, player):
+        """Drop a player that lost its voice connection, keeping its queue in the player store."""
+        guild_id = player._guild.id
+        if self.players.get(guild_id) is not player:
+            # !stop 或閒置已經清掉了
+            return
+        del self.players[guild_id]
+        player_store.suspend(guild_id)
+        await player.panel.close()
 
     async def __local_check(self, ctx):
         """A local check which applies to all commands in this cog."""
@@ -208,14 +681,56 @@ class Music(commands.Cog):
         traceback.print_exception(
             type(error), error, error.__traceback__, file=sys.stderr)
 
+    def pinned_files(self):
+        """Files that are playing or queued in any guild, the cache must keep them."""
+        pinned = set()
+        for player in self.players.values():
+            if player.current is not None:
+                pinned.add(player.current.file_url)
+                pinned.add(getattr(player.current, 'opus_url', None))
+            if player.mixer is not None and player.mixer.next is not None:
+                pinned.add(player.mixer.next.file_url)
+            for _, _, source in player.queue.items():
+                if isinstance(source, dict):
+                    pinned.add(source.get('file_url'))
+                    # 還沒 fetch 過的歌，檔案名稱只有自己的快取知道
+                    pinned.add(audio_cache.find(source.get('id')))
+        return pinned
+
+    def render_page(self, page):
+        """One page of !pl list. Cached until a title or the order changes."""
+        key = title_index.version, page
+        embed = self.pages.get(key)
+        if embed is not None:
+            self.pages.move_to_end(key)
+            return embed
+        total = len(library)
+        rows = library.titles(page * PAGE_SIZE + 1, PAGE_SIZE)
+        fmt = '\n'.join(f'**`{number}`**.**`{title}`**' for number, title in rows)
+        embed = discord.Embed(
+            title=f'自定義清單 -總共有 {total}首歌-第{page + 1}/{max(1, -(-total // PAGE_SIZE))}頁',
+            description=fmt or '這頁沒有歌')
+        self.pages[key] = embed
+        if len(self.pages) > 64:
+            self.pages.popitem(last=False)
+        return embed
+
     def get_player(self, ctx):
-        """Retrieve the guild player, or generate one."""
-        try:
-            player = self.players[ctx.guild.id]
-        except KeyError:
+        """Retrieve the guild player, or generate one.
+
+        A player is only generated while the bot is in a voice channel of the
+        guild; otherwise this returns the existing player or None.
+        """
+        player = self.players.get(ctx.guild.id)
+        if ctx.guild.voice_client is None:
+            return player
+        if player is None:
             player = MusicPlayer(ctx)
             self.players[ctx.guild.id] = player
 
+        # 重開之前的佇列等回到語音頻道再放回去
+        if ctx.guild.id in player_store.saved and ctx.guild.voice_client is not None:
+            player.restore(player_store.take(ctx.guild.id))
         return player
 
     @commands.command(name='connect', aliases=['join'])
@@ -255,6 +770,7 @@ class Music(commands.Cog):
 
         player = self.get_player(ctx)
         welcome = await ctx.send(f'Connected to: **{channel}**,你能使用下面按鈕自動點歌', delete_after=20)
+        controls.register(welcome.id, ctx.guild.id, panel_clicks, ttl=20)
         await welcome.add_reaction("🎵")
 
     @commands.command(name='clean')
@@ -263,7 +779,9 @@ class Music(commands.Cog):
         此指令會清空佇列和現在播放的歌曲，請小心使用
         """
         player = self.get_player(ctx)
-        player.queue = asyncio.PriorityQueue()
+        if player is None:
+            return await ctx.send('最高品質靜悄悄', delete_after=20)
+        player.queue.clear()
 
     @commands.command(name='play', aliases=['sing', 'p', 'P'])
     async def play_(self, ctx, *, search: str):
@@ -286,21 +804,16 @@ class Music(commands.Cog):
         player = self.get_player(ctx)
         # If download is False, source will be a dict which will be used later to regather the stream.
         # If download is True, source will be a discord.FFmpegPCMAudio with a VolumeTransformer.
-        with open('song.json', 'r') as f:
-            SongList = json.loads(f.read())
-        if ctx.author.id in SongList['ban']:
+        if library.is_banned(ctx.author.id):
             return await ctx.send('你沒有權限點歌')
 
         try:
             source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop)
         except Exception as e:
             return await ctx.send(f'```ini\n[抱歉{ctx.author.display_name}，現在可能沒辦法提供點歌服務，請使用歌單指令]\n原因:{e}```')
-        if source['id'] not in SongList['song']:
-            SongList['song'][source['id']] = {'title': source['title'], 'url': source['webpage_url'],
-                                              'requester': source['requester'], 'file_url': source['file_url']}
-            with open('song.json', 'w', encoding='utf8') as f:
-                json.dump(SongList, f, indent=4, ensure_ascii=False)
-        await player.queue.put((5, datetime.now().timestamp(), source))
+        library.add(source['id'], {'title': source['title'], 'url': source['webpage_url'],
+                                   'requester': source['requester']})
+        await player.queue.put((5, datetime.now().timestamp(), source), owner=ctx.author.id)
         return await ctx.send(f'```ini\n[{ctx.author.display_name} 新增 {source["title"]} 到佇列中]\n```', delete_after=10)
 
     @commands.command(name='add', aliases=['a'])
@@ -317,39 +830,61 @@ class Music(commands.Cog):
         songnum = int(inputstr.split(' ')[1])
         if songnum > 50 or songnum < 0:
             return await ctx.send(f'**`{ctx.author.display_name}`**,請輸入1~50間的數字')
-        SearchList = kkbox.search(songlang, songnum)
-        for i in SearchList:
-            source = await YTDLSource.create_source(ctx, i, loop=self.bot.loop, islist=True)
-            await player.queue.put((10, datetime.now().timestamp(), source))
-        return await ctx.send(f'```ini\n[{ctx.author.display_name}從新增{songnum}首歌]\n```')
+        SearchList = await self.bot.loop.run_in_executor(None, kkbox.search, songlang, songnum)
+        added = 0
+        async for search, source, error in YTDLSource.create_sources(ctx, SearchList, loop=self.bot.loop):
+            if error is not None:
+                print(f'{search}: {error}')
+                continue
+            await player.queue.put((10, datetime.now().timestamp(), source), owner=ctx.author.id)
+            added += 1
+        return await ctx.send(f'```ini\n[{ctx.author.display_name}從新增{added}首歌]\n```')
 
     @commands.command(name='playlist', aliases=['pl'])
     async def playlist_(self, ctx, *, inputstr: str):
         """自定義歌單，務必閱讀使用方法！！
         此指令有許多子指令，請詳細閱讀用法
-        ex:!pl list 列出自定義歌單所有歌曲
-           !pl play 'number' 匯入指定歌單中第幾首歌曲
-           !pl remove 'number' 刪除第幾首歌曲(從1開始數!!)
+        ex:!pl list 列出自定義歌單所有歌曲(可以加頁數,用按鈕換頁)
+           !pl find '歌名' 搜尋自定義歌單
+           !pl play 'number or 歌名' 匯入指定歌單中第幾首歌曲
+           !pl remove 'number or 歌名' 刪除第幾首歌曲(從1開始數!!)
            !pl 'number' 從歌單中取出 'number' 首歌
         """
         command = inputstr.split(' ')[0]
         if command == 'list':
-            with open('song.json', 'r') as f:
-                SongList = json.loads(f.read())
-            templist = [list(SongList['song'].keys())[i:i+20]
-                        for i in range(0, len(SongList['song']), 20)]
-            count = 0
-            channel = ctx.channel
-            for i in templist:
-                fmt = '\n'.join(
-                    f'**`{count*20+_+1}`**.**`{SongList["song"][i[_]]["title"]}`**' for _ in range(len(i)))
-                embed = discord.Embed(
-                    title=f'自定義清單 -總共有 {len(SongList["song"])}首歌-第{count*20+1}到{count*20+len(i)}', description=fmt)
-                await ctx.send(embed=embed)
-                count = count + 1
+            # 只送一則訊息，按按鈕換頁的時候才畫那一頁
+            try:
+                page = max(int(inputstr.split(' ')[1]) - 1, 0)
+            except (IndexError, ValueError):
+                page = 0
+            message = await ctx.send(embed=self.render_page(page))
+            if len(library) <= PAGE_SIZE:
+                return
+
+            async def turn(guild_id, clicks):
+                # 按下和收回都算按一次，這樣不用管理訊息的權限也能一直按；連按幾下只編輯一次
+                nonlocal page
+                last = max(0, -(-len(library) // PAGE_SIZE) - 1)
+                new_page = page
+                for click in clicks:
+                    new_page = {'⏪': 0, '◀️': new_page - 1, '▶️': new_page + 1, '⏩': last}.get(click.emoji, new_page)
+                    new_page = max(0, min(new_page, last))
+                if new_page != page:
+                    page = new_page
+                    await message.edit(embed=self.render_page(page))
+
+            controls.register(message.id, ctx.guild.id, turn, key=message.id, ttl=PAGE_TIMEOUT)
+            for emoji in PAGE_BUTTONS:
+                await message.add_reaction(emoji)
+        elif command == 'find':
+            text = ' '.join(inputstr.split(' ')[1:])
+            found = title_index.search(text, 10)
+            if not found:
+                return await ctx.send(f'```ini\n[自定義歌單裡找不到 {text}]\n```', delete_after=15)
+            fmt = '\n'.join(f'**`{title}`** ({int(score * 100)}%)' for score, _, title in found)
+            embed = discord.Embed(title=f'自定義清單搜尋 - {text}', description=fmt)
+            await ctx.send(embed=embed, delete_after=60)
         elif command == 'play':
-            with open('song.json', 'r') as f:
-                SongList = json.loads(f.read())
             await ctx.trigger_typing()
             vc = ctx.voice_client
             if not vc:
@@ -358,63 +893,77 @@ class Music(commands.Cog):
             # sepcific song
             if inputstr.split(' ')[1] is not None:
                 try:
-                    number = int(inputstr.split(' ')[1])
-                except:
-                    return await ctx.send(f"```ini\n[請輸入歌曲編號\n]```")
-                Song = SongList['song'][list(
-                    SongList['song'].keys())[number-1]]
+                    Song = library.at(int(inputstr.split(' ')[1]))
+                except ValueError:
+                    # 不是數字就當歌名找
+                    match = title_index.best(' '.join(inputstr.split(' ')[1:]))
+                    if match is None:
+                        return await ctx.send("```ini\n[自定義歌單裡找不到這首歌，可以用 !pl find 查查看]\n```")
+                    Song = library.get(match[1])
+                except IndexError:
+                    return await ctx.send(f"```ini\n[歌單只有{len(library)}首歌]\n```")
                 try:
                     if 'requester' not in Song:
                         Song['requester'] = ctx.author.display_name
-                    await player.queue.put((5, datetime.now().timestamp(), Song))
+                    await player.queue.put((5, datetime.now().timestamp(), Song), owner=ctx.author.id)
                     return await ctx.send(f'```ini\n[{ctx.author.display_name} 新增 {Song["title"]} 到佇列中]\n```', delete_after=10)
                 except Exception as e:
-                    return await ctx.send(f"```ini\n[機器人發現 第{number}首-{SongList['song'][number-1]['title']} 此首歌存在錯誤,請手動刪除]\n原因:{str(e)[7:]}```")
-                return await ctx.send(f"```ini\n[{ctx.author.display_name} 新增 {SongList['song'][number-1]['title']} 到佇列]\n```")
+                    return await ctx.send(f"```ini\n[機器人發現 {Song['title']} 此首歌存在錯誤,請手動刪除]\n原因:{str(e)[7:]}```")
+                return await ctx.send(f"```ini\n[{ctx.author.display_name} 新增 {Song['title']} 到佇列]\n```")
             else:
                 return await ctx.send(f"```ini\n[因為歌單太大，現在不支援匯入全部歌單]\n```", delete_after=15)
         elif command == 'remove':
             if inputstr.split(' ')[1] is not None:
-                with open('song.json', 'r') as f:
-                    SongList = json.loads(f.read())
                 if inputstr.split(' ')[1].isdigit() is True:
                     number = int(inputstr.split(' ')[1])
-                    Remove_song = SongList['song'].pop(
-                        list(SongList['song'].keys())[number-1])
+                    try:
+                        Remove_song = library.remove_at(number)
+                    except IndexError:
+                        return await ctx.send(f"```ini\n[歌單只有{len(library)}首歌]\n```")
                 else:
                     song = ' '.join(inputstr.split(' ')[1:])
+                    # 刪歌只認完整的歌名、id 或網址，很像的歌只列出來讓人確認
+                    song_id = title_index.exact(song)
+                    if song_id is None and re.match(r'https?://', song):
+                        # 只需要知道 id，不用下載
+                        try:
+                            source, _ = await YTDLSource.extract(song, loop=self.bot.loop, download=False)
+                        except Exception as e:
+                            print(e)
+                            return
+                        song_id = source['id']
+                    if song_id is None:
+                        found = [title for score, _, title in title_index.search(song, 3) if score >= 0.5]
+                        if not found:
+                            return await ctx.send(f'```ini\n[自定義歌單裡找不到 {song}]\n```', delete_after=15)
+                        embed = discord.Embed(title='找不到完全一樣的歌名，是要刪這些嗎? 請輸入完整歌名',
+                                              description='\n'.join(f'**`{title}`**' for title in found))
+                        return await ctx.send(embed=embed, delete_after=30)
                     try:
-                        source = await YTDLSource.create_source(ctx, song, loop=self.bot.loop)
-                    except Exception as e:
-                        print(e)
-                        return
-                    Remove_song = SongList['song'].pop(source['id'])
+                        Remove_song = library.remove(song_id)
+                    except KeyError:
+                        return await ctx.send(f'```ini\n[{song} 不在自定義播放清單中]\n```', delete_after=15)
             else:
                 return await ctx.send('remove 此功能的參數必須是數字或是歌名 ex:!pl remove "1 or 白月光"')
-            with open('song.json', 'w', encoding='utf8') as f:
-                json.dump(SongList, f, indent=4, ensure_ascii=False)
             return await ctx.send(f'```ini\n[{ctx.author.display_name} 從自定義播放清單中移除 {Remove_song["title"]}]\n```', delete_after=15)
         elif command.isdigit():
-            with open('song.json', 'r') as f:
-                SongList = json.loads(f.read())
             num = int(command)
             await ctx.trigger_typing()
             vc = ctx.voice_client
             if not vc:
                 await ctx.invoke(self.connect_)
             player = self.get_player(ctx)
-            random.seed(datetime.now().timestamp())
-            temp_songlist = list(SongList['song'].keys())
-            random.shuffle(temp_songlist)
-            for i in temp_songlist[:num]:
-                Song = SongList['song'][i]
+            added = 0
+            for Song in sampler.sample(num, guild_id=ctx.guild.id, weighted=WEIGHTED_SAMPLING,
+                                       exclude=player.queue.contains):
                 try:
                     if 'requester' not in Song:
                         Song['requester'] = ctx.author.display_name
-                    await player.queue.put((10, datetime.now().timestamp(), Song))
+                    await player.queue.put((10, datetime.now().timestamp(), Song), owner=ctx.author.id)
+                    added += 1
                 except Exception as e:
                     pass
-            return await ctx.send(f'```ini\n[{ctx.author.display_name} 新增 {num}首歌到佇列]\n```')
+            return await ctx.send(f'```ini\n[{ctx.author.display_name} 新增 {added}首歌到佇列]\n```')
 
     @commands.command(name='force', aliases=['f'])
     async def force_(self, ctx, *, search: str):
@@ -427,14 +976,9 @@ class Music(commands.Cog):
 
         player = self.get_player(ctx)
         source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop)
-        with open('song.json', 'r') as f:
-            SongList = json.loads(f.read())
-        if source['id'] not in SongList['song']:
-            SongList['song'][source['id']] = {'title': source['title'], 'url': source['webpage_url'],
-                                              'requester': source['requester'], 'file_url': source['file_url']}
-            with open('song.json', 'w', encoding='utf8') as f:
-                json.dump(SongList, f, indent=4, ensure_ascii=False)
-        return await player.queue.put((1, datetime.now().timestamp(), source))
+        library.add(source['id'], {'title': source['title'], 'url': source['webpage_url'],
+                                   'requester': source['requester']})
+        return await player.queue.put((1, datetime.now().timestamp(), source), owner=ctx.author.id)
 
     @commands.command(name='pause')
     async def pause_(self, ctx):
@@ -475,7 +1019,7 @@ class Music(commands.Cog):
         elif not vc.is_playing():
             return
 
-        vc.stop()
+        self.get_player(ctx).skip()
         await ctx.send(f'**`{ctx.author.display_name}`**: 跳過此首歌曲!', delete_after=15)
 
     @commands.command(name='queue', aliases=['q'])
@@ -490,13 +1034,67 @@ class Music(commands.Cog):
         if player.queue.empty():
             return await ctx.send('佇列已沒有任何歌曲，點歌阿')
         # Grab up to 15 entries from the queue...
-        upcoming = list(itertools.islice(player.queue._queue, 0, 15))
-        fmt = '\n'.join(f'**`{_[2]["title"]}`**' for _ in upcoming)
+        upcoming = player.queue.peek(15)
+        fmt = '\n'.join(f'**`{n}`**.**`{_[2]["title"]}`**' for n, _ in enumerate(upcoming, 1))
         embed = discord.Embed(
             title=f'即將播放 - 總共有{player.queue.qsize()}首 - Next {len(upcoming)}', description=fmt)
 
         await ctx.send(embed=embed, delete_after=20)
 
+    @commands.command(name='remove', aliases=['rm'])
+    async def remove_(self, ctx, *, position: int):
+        """從佇列移除第幾首歌(從1開始數,看!q)
+        ex:!rm 3
+        """
+        player = self.get_player(ctx)
+        if player is None:
+            return await ctx.send('最高品質靜悄悄', delete_after=20)
+        try:
+            _, _, source = player.queue.remove(position)
+        except IndexError:
+            return await ctx.send(f'佇列只有{player.queue.qsize()}首歌', delete_after=15)
+        await ctx.send(f'```ini\n[{ctx.author.display_name} 從佇列移除 {source["title"]}]\n```', delete_after=15)
+
+    @commands.command(name='move', aliases=['mv'])
+    async def move_(self, ctx, position: int, target: int):
+        """把佇列裡第幾首歌移到第幾首
+        ex:!mv 5 1 把第5首移到最前面
+        """
+        player = self.get_player(ctx)
+        if player is None:
+            return await ctx.send('最高品質靜悄悄', delete_after=20)
+        try:
+            _, _, source = player.queue.move(position, target)
+        except IndexError:
+            return await ctx.send(f'佇列只有{player.queue.qsize()}首歌', delete_after=15)
+        await ctx.send(f'```ini\n[{ctx.author.display_name} 把 {source["title"]} 移到第{target}首]\n```', delete_after=15)
+
+    @commands.command(name='dedupe')
+    async def dedupe_(self, ctx):
+        """移除佇列裡重複的歌"""
+        player = self.get_player(ctx)
+        if player is None:
+            return await ctx.send('最高品質靜悄悄', delete_after=20)
+        removed = player.queue.dedupe()
+        await ctx.send(f'```ini\n[移除了{removed}首重複的歌]\n```', delete_after=15)
+
+    @commands.command(name='sched')
+    async def sched_(self, ctx, *, name: str = None):
+        """佇列排序方式
+        ex:!sched strict 照優先度(插歌>點歌>歌單)
+           !sched rr 點歌的人輪流
+           !sched wfq 加權公平,大量加歌不會卡住別人點的歌
+        """
+        player = self.get_player(ctx)
+        if player is None:
+            return await ctx.send('最高品質靜悄悄', delete_after=20)
+        if name is None:
+            return await ctx.send(f'現在的排序方式: **{player.queue.scheduler.name}**', delete_after=15)
+        if name not in SCHEDULERS:
+            return await ctx.send(f'請輸入 {", ".join(SCHEDULERS)}', delete_after=15)
+        player.queue.set_scheduler(SCHEDULERS[name]())
+        await ctx.send(f'**`{ctx.author.display_name}`**: 將排序方式設定為 **{name}**', delete_after=15)
+
     @commands.command(name='now_playing', aliases=['np', 'current', 'currentsong', 'playing'])
     async def now_playing_(self, ctx):
         """顯示現在正在播放的歌曲"""
@@ -509,14 +1107,8 @@ class Music(commands.Cog):
         if not player.current:
             return await ctx.send('最高品質靜悄悄', delete_after=20)
 
-        try:
-            # Remove our previous now_playing message.
-            await player.np.delete()
-        except discord.HTTPException:
-            pass
-
-        player.np = await ctx.send(f'**正在播放:** `{vc.source.title}` '
-                                   f'由`{vc.source.requester}`點播')
+        # Move the now playing message to the bottom of this channel.
+        player.panel.repost(ctx.channel)
 
     @commands.command(name='volume', aliases=['vol', 'v'])
     async def change_volume(self, ctx, *, vol: float):
@@ -542,8 +1134,86 @@ class Music(commands.Cog):
             vc.source.volume = vol / 100
         print('not in vc-source')
         player.volume = vol / 100
+        if getattr(vc.source, 'passthrough', False):
+            return await ctx.send(f'**`{ctx.author.display_name}`**: 將音量設定為 **{vol}%** (下一首生效)', delete_after=30)
         await ctx.send(f'**`{ctx.author.display_name}`**: 將音量設定為 **{vol}%**', delete_after=30)
 
+    @commands.command(name='cache')
+    async def cache_(self, ctx, *, inputstr: str = 'stats'):
+        """下載快取
+        ex:!cache stats 顯示快取用量
+        """
+        if inputstr.split(' ')[0] != 'stats':
+            return await ctx.send('ex:!cache stats', delete_after=15)
+        stats = audio_cache.stats()
+        fmt = '\n'.join([
+            f'檔案: **{stats["files"]}**',
+            f'用量: **{stats["bytes"] / 1024 ** 2:.1f} / {stats["budget"] / 1024 ** 2:.0f} MB**',
+            f'策略: **{stats["policy"]}**',
+            f'播放中或佇列中: **{stats["pinned"]}**',
+            f'已清除: **{stats["evicted"]}** 首 ({stats["evicted_bytes"] / 1024 ** 2:.1f} MB)',
+        ])
+        await ctx.send(embed=discord.Embed(title='下載快取', description=fmt), delete_after=30)
+
+    @commands.command(name='stats')
+    async def stats_(self, ctx, *, inputstr: str = 'top'):
+        """播放統計
+        ex:!stats top 最常播的歌
+           !stats user 自己的點歌統計(也可以 !stats user 名字)
+        """
+        command = inputstr.split(' ')[0]
+        if command == 'top':
+            top = history.top(10)
+            if not top:
+                return await ctx.send('還沒有播放紀錄', delete_after=15)
+            fmt = '\n'.join(f'**`{n}`**.**`{title}`** - {plays}次' for n, (_, title, plays) in enumerate(top, 1))
+            embed = discord.Embed(title=f'最常播放 - 總共播了{history.total}首', description=fmt)
+        elif command == 'user':
+            name = ' '.join(inputstr.split(' ')[1:]) or ctx.author.display_name
+            stats = history.user(name)
+            fmt = '\n'.join([
+                f'點播: **{stats["plays"]}** 首，跳過 **{stats["skips"]}** 首',
+                f'總共聽了: **{stats["seconds"] / 3600:.1f}** 小時',
+                f'自定義歌單裡有 **{len(library.by_requester(name))}** 首',
+            ] + [f'**`{title}`** - {plays}次' for _, title, plays in stats['top']])
+            embed = discord.Embed(title=f'{name} 的點歌統計', description=fmt)
+        else:
+            return await ctx.send('ex:!stats top 或 !stats user', delete_after=15)
+        await ctx.send(embed=embed, delete_after=60)
+
+    @commands.command(name='debug')
+    async def debug_(self, ctx, *, inputstr: str = 'perf'):
+        """效能數據
+        ex:!debug perf 顯示下載、播放和 Discord API 花的時間
+        """
+        if inputstr.split(' ')[0] != 'perf':
+            return await ctx.send('ex:!debug perf', delete_after=15)
+
+        def timing(name, histogram, **labels):
+            count = histogram.count(**labels)
+            if not count:
+                return f'{name}: 沒有資料'
+            return (f'{name}: p50 **{histogram.quantile(.5, **labels) * 1000:.0f}ms** '
+                    f'p95 **{histogram.quantile(.95, **labels) * 1000:.0f}ms** ({count}次)')
+
+        routes = sorted(DISCORD_SECONDS.keys(), key=lambda labels: -DISCORD_SECONDS.count(**labels))[:5]
+        fmt = '\n'.join([
+            timing('點歌到下載好', CREATE_SOURCE_SECONDS),
+            timing('youtube-dl 下載', EXTRACT_SECONDS, download=True),
+            timing('youtube-dl 查資料', EXTRACT_SECONDS, download=False),
+            timing('FFmpeg 啟動', FFMPEG_START_SECONDS, mode='pcm'),
+            timing('歌與歌之間', TRACK_GAP_SECONDS),
+            f'資訊快取: 命中 **{info_cache.hits}** 次，沒命中 **{info_cache.misses}** 次',
+            f'youtube-dl: 忙碌 **{extraction.busy}/{extraction.workers}**，排隊 **{extraction.waiting}**，'
+            f'失敗 **{extraction.failed}**，逾時 **{extraction.timeouts}**',
+            f'播放: **{len(self.players)}** 個伺服器，佇列 **{sum(len(p.queue) for p in self.players.values())}** 首，'
+            f'錯誤 **{PLAYER_ERRORS.value()}** 首',
+            f'記憶體: player 約 **{sum(p.memory() for p in self.players.values()) / 1024:.0f} KiB**，'
+            f'收起來等重連 **{len(player_store.saved)}** 個伺服器',
+            f'Gateway 延遲: **{self.bot.latency * 1000:.0f}ms**',
+        ] + [timing(f'`{labels["method"]} {labels["route"]}`', DISCORD_SECONDS, **labels) for labels in routes])
+        await ctx.send(embed=discord.Embed(title='效能數據', description=fmt), delete_after=60)
+
     @commands.command(name='members')
     async def show_members(self, ctx):
         """成員指令
@@ -560,14 +1230,7 @@ class Music(commands.Cog):
         if ctx.author.id != 211813274730233857:
             return await ctx.send('nono')
         else:
-            with open('song.json') as f:
-                user = json.loads(f.read())
-            if inputid not in user['ban']:
-                user['ban'].append(inputid)
-                with open('song.json', 'w', encoding='utf8') as f:
-                    json.dump(user, f, indent=4, ensure_ascii=False)
-            else:
-                return
+            library.ban(inputid)
 
     @commands.command(name='stop')
     async def stop_(self, ctx):
@@ -593,83 +1256,85 @@ class Music(commands.Cog):
         await ctx.channel.purge(check=check, limit=100)
 
 
-bot = commands.Bot(command_prefix=commands.when_mentioned_or(
-    '!'), description='Made by Tamama\n痾 那個阿 歌單不小心在更新更失敗，所以都不見了')
+bot = None
+# 此變數用來處理reaction,取得Music Player
+Main_bot = None
+
+
+async def on_raw_reaction_add(payload):
+    if payload.member is not None and payload.member.bot:
+        return
+    controls.click(payload, added=True)
 
 
-@bot.event
-async def on_raw_reaction_add(reaction):
-    if reaction.member.bot:
+async def on_raw_reaction_remove(payload):
+    if payload.user_id == bot.user.id:
         return
-    else:
-        emoji = reaction.emoji.name
-        vc = reaction.member.guild.voice_client
-        channel = discord.utils.get(
-            reaction.member.guild.text_channels, id=reaction.channel_id)
-        if emoji == "⏭️":
-            await skip(vc, channel, reaction)
-        elif emoji == "⏯️":
-            await playorpause(vc)
-        elif emoji == "⏹️":
-            await stop(vc, channel, reaction)
-        elif emoji == "🎵":
-            await auto(vc, channel, reaction)
-        elif emoji == "🔊":
-            await louder(vc, channel, reaction)
-        elif emoji == "🔉":
-            await lower(vc, channel, reaction)
-        elif emoji == "📃":
-            await queue(vc, channel, reaction)
-
-
-@bot.event
-async def on_reaction_remove(reaction, user):
-    if reaction.emoji == "⏯️":
-        vc = user.guild.voice_client
-        await playorpause(vc)
+    controls.click(payload, added=False)
 
 
-async def queue(vc, channel, reaction):
-    player = Main_bot.get_player(ctx=reaction.member)
+async def panel_clicks(guild_id, clicks):
+    """The buttons of a now playing message (or the welcome message), a burst at a time."""
+    guild = bot.get_guild(guild_id)
+    channel = bot.get_channel(clicks[-1].channel_id)
+    if guild is None or channel is None:
+        return
+    member = guild.get_member(clicks[-1].user_id)
+    name = member.display_name if member is not None else clicks[-1].user_id
+    # 不會因為有人按了按鈕就建立 player
+    player = Main_bot.players.get(guild_id)
+    vc = guild.voice_client
+    # 面板訊息一直是同一則，按過的 reaction 會留著: 按下和收回都算按一次，跟 !pl list 的翻頁一樣
+    pressed = collections.Counter(click.emoji for click in clicks)
+    if pressed['⏹️']:
+        return await stop(vc, channel, guild)
+    # ⏯️ 按兩次等於沒按
+    if pressed['⏯️'] % 2:
+        await playorpause(vc)
+    steps = pressed['🔊'] - pressed['🔉']
+    if steps and player is not None:
+        await change_volume(vc, channel, player, name, steps * 2 / 100)
+    if pressed['⏭️']:
+        await skip(vc, channel, player, name)
+    if pressed['🎵']:
+        await auto(vc, channel, player, guild_id, name, clicks[-1].user_id)
+    if pressed['📃'] and player is not None:
+        await queue(channel, player)
+
+
+async def queue(channel, player):
     if player.queue.empty():
         return await channel.send('佇列已沒有任何歌曲，點歌阿')
 
-    upcoming = list(itertools.islice(player.queue._queue, 0, 15))
-    fmt = '\n'.join(f'**`{_[2]["title"]}`**' for _ in upcoming)
+    upcoming = player.queue.peek(15)
+    fmt = '\n'.join(f'**`{n}`**.**`{_[2]["title"]}`**' for n, _ in enumerate(upcoming, 1))
     embed = discord.Embed(
         title=f'即將播放 - 總共有{player.queue.qsize()}首 - Next {len(upcoming)}', description=fmt)
     await channel.send(embed=embed)
 
 
-async def louder(vc, channel, reaction):
-    player = Main_bot.get_player(ctx=reaction.member)
-    if vc.source:
-        vc.source.volume = vc.source.volume + (2/100)
-
-    player.volume = player.volume + (2/100)
-    await channel.send(f'**`{reaction.member.display_name}`**: 將音量設定為 **{int(player.volume*100)}%**', delete_after=30)
-
+async def change_volume(vc, channel, player, name, delta):
+    if vc and vc.source:
+        vc.source.volume = vc.source.volume + delta
 
-async def lower(vc, channel, reaction):
-    player = Main_bot.get_player(ctx=reaction.member)
-    if vc.source:
-        vc.source.volume = vc.source.volume - (2/100)
+    player.volume = player.volume + delta
+    await channel.send(f'**`{name}`**: 將音量設定為 **{int(player.volume*100)}%**', delete_after=30)
 
-    player.volume = player.volume - (2/100)
-    await channel.send(f'**`{reaction.member.display_name}`**: 將音量設定為 **{int(player.volume*100)}%**', delete_after=30)
 
-
-async def skip(vc, channel, reaction):
+async def skip(vc, channel, player, name):
     if not vc or not vc.is_connected():
-        return await ctx.send('最高品質靜悄悄', delete_after=20)
+        return await channel.send('最高品質靜悄悄', delete_after=20)
 
     if vc.is_paused():
         pass
     elif not vc.is_playing():
         return
 
-    vc.stop()
-    await channel.send(f'**`{reaction.member.display_name}`**: 跳過此首歌曲!', delete_after=15)
+    if player is not None:
+        player.skip()
+    else:
+        vc.stop()
+    await channel.send(f'**`{name}`**: 跳過此首歌曲!', delete_after=15)
 
 
 async def playorpause(vc):
@@ -681,40 +1346,149 @@ async def playorpause(vc):
     vc.resume()
 
 
-async def stop(vc, channel, reaction):
+async def stop(vc, channel, guild):
     if not vc or not vc.is_connected():
         return await channel.send('最高品質靜悄悄', delete_after=20)
 
-    await Main_bot.cleanup(guild=reaction.member.guild)
+    await Main_bot.cleanup(guild=guild)
     def check(
         message): return message.author.id == bot.user.id or '!' in message.content
     await channel.purge(check=check, limit=100)
 
 
-async def auto(vc, channel, reaction):
-    with open('song.json', 'r') as f:
-        SongList = json.loads(f.read())
-    player = Main_bot.get_player(ctx=reaction.member)
-    random.seed(datetime.now().timestamp())
-    temp_songlist = list(SongList['song'].keys())
-    random.shuffle(temp_songlist)
-    for i in temp_songlist[:100]:
-        Song = SongList['song'][i]
+def forget_file(song_id, file_url):
+    """The cache deleted a file, its loudness isn't needed anymore."""
+    # song.db 不存檔名 (每個 worker 的資料夾不一樣)，不用改
+    loudness.forget(file_url)
+
+
+async def auto(vc, channel, player, guild_id, name, user_id):
+    if player is None or not vc or not vc.is_connected():
+        return await channel.send('請先用 !join 讓我進語音頻道', delete_after=20)
+    added = 0
+    for Song in sampler.sample(100, guild_id=guild_id, weighted=WEIGHTED_SAMPLING,
+                               exclude=player.queue.contains):
         try:
             if 'requester' not in Song:
-                Song['requester'] = reaction.member.display_name
-            await player.queue.put((10, datetime.now().timestamp(), Song))
+                Song['requester'] = name
+            await player.queue.put((10, datetime.now().timestamp(), Song), owner=user_id)
+            added += 1
         except Exception as e:
             pass
-    return await channel.send(f'```ini\n[{reaction.member.display_name} 新增 100首歌到佇列]\n```', delete_after=20)
+    return await channel.send(f'```ini\n[{name} 新增 {added}首歌到佇列]\n```', delete_after=20)
+
+
+def time_discord_requests(http):
+    """Time every Discord REST call the bot makes, by route."""
+    request = http.request
+
+    async def timed(route, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        finally:
+            DISCORD_SECONDS.observe(time.perf_counter() - start, method=route.method, route=route.path)
+
+    http.request = timed
+
+
+async def serve_metrics():
+    """Prometheus endpoint at METRICS_HOST:METRICS_PORT/metrics."""
+    async def handle(request):
+        return web.Response(body=REGISTRY.render().encode('utf8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        print(f'metrics: could not listen on {METRICS_HOST}:{METRICS_PORT}: {e}')
+
+
+async def prewarm():
+    """Download the first songs of the saved queues before anybody asks for them."""
+    await bot.wait_until_ready()
+    semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+
+    async def warm(source):
+        async with semaphore:
+            try:
+                await YTDLSource.ensure_local(source, loop=bot.loop)
+            except Exception as e:
+                print(f'prewarm {source.get("title")}: {e}')
+
+    sources = {}
+    for source in player_store.saved_songs(LOOKAHEAD):
+        sources.setdefault(source.get('id') or source.get('webpage_url'), source)
+    await asyncio.gather(*(warm(source) for source in sources.values()))
+
+
+async def refresh_library():
+    """Pick up songs other workers added or removed, for the in-memory indexes."""
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        library.refresh()
+        await asyncio.sleep(LIBRARY_REFRESH)
 
 
-@bot.event
 async def on_ready():
     print('Logged in as:\n{0} (ID: {0.id})'.format(bot.user))
-# 此變數用來處理reaction,取得Music Player
-Main_bot = Music(bot)
-bot.add_cog(Main_bot)
-with open('key.txt', 'r') as f:
-    key = f.read()
-bot.run(key.strip())
+
+
+def main():
+    """Set up the state files, the youtube-dl workers and the bot, and run until it stops."""
+    global extraction, audio_cache, info_cache, loudness, history, library, sampler, title_index, player_store
+    global bot, Main_bot
+    extraction = ExtractionPool(DOWNLOAD_DIR, workers=EXTRACT_WORKERS, timeout=EXTRACT_TIMEOUT,
+                                fields=InfoCache.FIELDS)
+    audio_cache = AudioCache(DOWNLOAD_DIR, budget=CACHE_BUDGET // WORKERS, policy=CACHE_POLICY)
+    info_cache = InfoCache(state_path('info_cache.json'), ttl=24 * 3600)
+    loudness = Loudness(state_path('loudness.json'), target=-16.0, true_peak=-1.5)
+    history = PlayHistory(state_path('history.jsonl'))
+    bot = commands.AutoShardedBot(command_prefix=commands.when_mentioned_or(
+        '!'), description='Made by Tamama\n痾 那個阿 歌單不小心在更新更失敗，所以都不見了',
+        shard_ids=SHARD_IDS, shard_count=SHARD_COUNT)
+    for handler in (on_ready, on_raw_reaction_add, on_raw_reaction_remove):
+        bot.event(handler)
+    Main_bot = Music(bot)
+    bot.add_cog(Main_bot)
+    library = open_library(LIBRARY_PATH)
+    sampler = SongSampler(library, recent=RECENT_SONGS).load()
+    title_index = TitleIndex(library).load()
+    player_store = PlayerStore(PLAYERS_PATH, library).load()
+    history.load()
+    if WEIGHTED_SAMPLING:
+        sampler.weight = history.weight
+    audio_cache.load()
+    info_cache.load()
+    loudness.load()
+    audio_cache.pinned = Main_bot.pinned_files
+    audio_cache.on_evict = forget_file
+    opus_variants.on_ready = lambda file_url, opus_url: audio_cache.add(opus_url, AudioCache.song_id(opus_url))
+    extraction.start()
+    bot.loop.create_task(refresh_library())
+    bot.loop.create_task(prewarm())
+    time_discord_requests(bot.http)
+    bot.loop.create_task(serve_metrics())
+    with open('key.txt', 'r') as f:
+        key = f.read()
+    try:
+        bot.run(key.strip())
+    finally:
+        # 要在歌單關掉之前存，歌單裡的歌只存 id
+        player_store.close()
+        extraction.close()
+        history.close()
+        library.close()
+        audio_cache.close()
+        info_cache.close()
+        loudness.close()
+
+
+# youtube-dl 的 worker process (spawn) 會把這個檔案當成 __mp_main__ 再 import 一次，
+# 所以 import 的時候只定義東西，快取、bot 這些都在 main() 裡才建
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+import asyncio
+import collections
+import json
+import os
+import re
+import time
+
+from writebehind import WriteBehind
+
+# loudness.OpusVariants 轉出來的 youtube-<id>.v10.opus
+VARIANT = re.compile(r'\.v\d+\.opus$')
+
+
+class AudioCache:
+    """Keeps the downloads/ folder under a byte budget.
+
+    Files are named after the video id by youtube-dl (youtube-<id>.webm), so
+    the file name is the cache key. The index remembers the size, last play
+    time and play count of every file; when the folder grows over the budget
+    the least recently (or least frequently) played files are deleted, except
+    the ones that are queued or playing somewhere.
+
+    The folder belongs to one worker. find() answers which file holds a
+    song here; a file name from song.db may be another worker's.
+    """
+
+    PARTIAL = ('.part', '.tmp')
+
+    def __init__(self, directory='downloads', *, budget, policy='lru', grace=600):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.json')
+        self.budget = budget
+        self.policy = policy
+        # 剛下載的檔案可能還沒進佇列，先不要刪
+        self.grace = grace
+        self.entries = {}
+        self.total = 0
+        self._files = {}  # song id -> 下載的檔案 (不含 Opus 版本)
+        self.evicted = 0
+        self.evicted_bytes = 0
+
+        # 由 Music cog 設定
+        self.pinned = set
+        self.on_evict = None
+
+        self._evict_task = None
+        self._saver = WriteBehind(self.index_path, lambda: json.dumps(self.entries), delay=30)
+
+    @staticmethod
+    def song_id(file_url):
+        """youtube-<id>.webm (or youtube-<id>.v10.opus) -> <id>"""
+        name = os.path.basename(file_url).split('.', 1)[0]
+        return name.split('-', 1)[1] if '-' in name else name
+
+    def load(self):
+        """Read the index and reconcile it with what is actually on disk.
+
+        Unfinished downloads and encodes left behind by a crash are deleted.
+        """
+        try:
+            with open(self.index_path, 'r', encoding='utf8') as f:
+                entries = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            entries = {}
+        self.entries = {}
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or entry.path == self.index_path:
+                    continue
+                if entry.name.endswith(self.PARTIAL):
+                    # 上次當掉時寫到一半的檔案 (youtube-dl 的 .part、轉檔和存檔的 .tmp)，
+                    # load() 在開始下載之前跑，不會是別人正在寫的
+                    self._remove_files([entry.path])
+                    continue
+                old = entries.get(entry.path, {})
+                self.entries[entry.path] = {
+                    'id': old.get('id') or self.song_id(entry.path),
+                    'size': entry.stat().st_size,
+                    'last_played': old.get('last_played', entry.stat().st_mtime),
+                    'plays': old.get('plays', 0),
+                }
+        self.total = sum(entry['size'] for entry in self.entries.values())
+        self._files = {entry['id']: file_url for file_url, entry in self.entries.items()
+                       if not VARIANT.search(file_url)}
+        return self
+
+    def find(self, song_id):
+        """The downloaded file of *song_id* in this folder, or None."""
+        return self._files.get(song_id)
+
+    def add(self, file_url, song_id):
+        """Register a freshly downloaded file."""
+        try:
+            size = os.path.getsize(file_url)
+        except OSError:
+            return
+        old = self.entries.get(file_url)
+        if old is not None:
+            self.total -= old['size']
+        self.entries[file_url] = {
+            'id': song_id,
+            'size': size,
+            'last_played': time.time(),
+            'plays': old['plays'] if old else 0,
+        }
+        self.total += size
+        if not VARIANT.search(file_url):
+            self._files[song_id] = file_url
+        self._saver.changed()
+        if self.total > self.budget:
+            self.schedule_evict()
+
+    def played(self, file_url):
+        entry = self.entries.get(file_url)
+        if entry is not None:
+            entry['last_played'] = time.time()
+            entry['plays'] += 1
+            self._saver.changed()
+
+    def _victims(self):
+        if self.policy == 'lfu':
+            def key(item): return (item[1]['plays'], item[1]['last_played'])
+        else:
+            def key(item): return item[1]['last_played']
+        pinned = self.pinned()
+        fresh = time.time() - self.grace
+        # 刪到 90% 就停，不然每下載一首就要再刪一次
+        target = self.total - self.budget * 0.9
+        victims = []
+        for file_url, entry in sorted(self.entries.items(), key=key):
+            if target <= 0:
+                break
+            if file_url in pinned or entry['last_played'] > fresh:
+                continue
+            victims.append((file_url, entry))
+            target -= entry['size']
+        return victims
+
+    def schedule_evict(self):
+        if self._evict_task is None:
+            self._evict_task = asyncio.get_event_loop().create_task(self.evict())
+
+    async def evict(self):
+        """Delete files until the cache is back under its budget."""
+        try:
+            victims = self._victims()
+            if not victims:
+                return
+            loop = asyncio.get_event_loop()
+            removed = await loop.run_in_executor(None, self._remove_files, [file_url for file_url, _ in victims])
+            for file_url, entry in victims:
+                if file_url not in removed:
+                    continue
+                # 下載中途又被加回來的話就不算
+                if self.entries.get(file_url) is entry:
+                    del self.entries[file_url]
+                    self.total -= entry['size']
+                if self._files.get(entry['id']) == file_url:
+                    del self._files[entry['id']]
+                self.evicted += 1
+                self.evicted_bytes += entry['size']
+                if self.on_evict is not None:
+                    self.on_evict(entry['id'], file_url)
+            self._saver.changed()
+        finally:
+            self._evict_task = None
+
+    @staticmethod
+    def _remove_files(file_urls):
+        removed = set()
+        for file_url in file_urls:
+            try:
+                os.remove(file_url)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f'cache: could not remove {file_url}: {e}')
+                continue
+            removed.add(file_url)
+        return removed
+
+    def stats(self):
+        return {
+            'files': len(self.entries),
+            'bytes': self.total,
+            'budget': self.budget,
+            'policy': self.policy,
+            'evicted': self.evicted,
+            'evicted_bytes': self.evicted_bytes,
+            'pinned': len(self.pinned()),
+        }
+
+    def close(self):
+        self._saver.close()
+
+
+class InfoCache:
+    """Remembers what youtube-dl resolved a search or URL to.
+
+    Only the few fields the bot uses are kept. Entries expire after *ttl*
+    seconds; the least recently used ones are dropped past *size* entries.
+    """
+
+    FIELDS = ('id', 'title', 'webpage_url', 'extractor', 'ext', 'duration')
+
+    def __init__(self, path='info_cache.json', *, ttl=24 * 3600, size=20000):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._saver = WriteBehind(path, lambda: json.dumps(self.entries, ensure_ascii=False), delay=60)
+
+    @staticmethod
+    def key(search):
+        search = ' '.join(search.split())
+        if search.startswith(('http://', 'https://')):
+            return search
+        # 搜尋字串不分大小寫
+        return search.casefold()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf8') as f:
+                entries = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            entries = {}
+        now = time.time()
+        self.entries = collections.OrderedDict(
+            (key, entry) for key, entry in entries.items() if entry['expires'] > now)
+        return self
+
+    def get(self, search):
+        """Return (info, file_url) for *search*, or None."""
+        key = self.key(search)
+        entry = self.entries.get(key)
+        if entry is None or entry['expires'] < time.time():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return dict(entry['info']), entry['file_url']
+
+    def put(self, search, data, file_url):
+        """Store a youtube-dl info dict and return the trimmed copy."""
+        info = {field: data.get(field) for field in self.FIELDS}
+        entry = {'info': info, 'file_url': file_url, 'expires': time.time() + self.ttl}
+        # 用網址再點一次也會命中
+        for key in {self.key(search), self.key(info['webpage_url'] or search)}:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        self._saver.changed()
+        return dict(info)
+
+    def close(self):
+        self._saver.close()
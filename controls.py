@@ -0,0 +1,89 @@
+import asyncio
+import collections
+import traceback
+
+Click = collections.namedtuple('Click', 'emoji user_id channel_id message_id added')
+
+
+class _Target:
+    __slots__ = ('guild_id', 'handler', 'key', 'ttl', 'expiry')
+
+    def __init__(self, guild_id, handler, key, ttl):
+        self.guild_id = guild_id
+        self.handler = handler
+        self.key = key
+        self.ttl = ttl
+        self.expiry = None
+
+
+class Controls:
+    """Routes reactions on the bot's button messages to their handlers.
+
+    Only registered messages (now playing panels, the welcome message, !pl
+    list pages) are looked at, with one dict lookup, so reactions anywhere
+    else cost nothing. Clicks are collected per key, the guild unless the
+    message asks for its own, for *delay* seconds and handed to the handler
+    together. The handler applies their net effect once: five 🔊 are one
+    +10%, ⏯️ twice is nothing.
+    """
+
+    def __init__(self, delay=0.75):
+        self.delay = delay
+        self._targets = {}  # message id -> _Target
+        self._pending = {}  # key -> (handler, guild id, [Click])
+
+    def __contains__(self, message_id):
+        return message_id in self._targets
+
+    def register(self, message_id, guild_id, handler, *, key=None, ttl=None):
+        """Send clicks on *message_id* to ``await handler(guild_id, clicks)``.
+
+        With *ttl* the message is forgotten that many seconds after its last click.
+        """
+        self.unregister(message_id)
+        target = self._targets[message_id] = _Target(guild_id, handler, key or guild_id, ttl)
+        self._expire_later(message_id, target)
+
+    def unregister(self, message_id):
+        target = self._targets.pop(message_id, None)
+        if target is not None and target.expiry is not None:
+            target.expiry.cancel()
+
+    def _expire_later(self, message_id, target):
+        if target.ttl is None:
+            return
+        if target.expiry is not None:
+            target.expiry.cancel()
+        target.expiry = asyncio.get_event_loop().call_later(target.ttl, self._expire, message_id, target)
+
+    def _expire(self, message_id, target):
+        if self._targets.get(message_id) is target:
+            del self._targets[message_id]
+
+    def click(self, payload, *, added):
+        """Feed a raw reaction event. Returns whether it was on a registered message."""
+        target = self._targets.get(payload.message_id)
+        if target is None:
+            return False
+        self._expire_later(payload.message_id, target)
+        click = Click(payload.emoji.name, payload.user_id, payload.channel_id, payload.message_id, added)
+        pending = self._pending.get(target.key)
+        if pending is None:
+            # 第一下開始計時，時間到一起處理，一直按也不會一直延後
+            self._pending[target.key] = (target.handler, target.guild_id, [click])
+            asyncio.get_event_loop().call_later(self.delay, self._fire, target.key)
+        else:
+            pending[2].append(click)
+        return True
+
+    def _fire(self, key):
+        handler, guild_id, clicks = self._pending.pop(key)
+        asyncio.get_event_loop().create_task(self._run(handler, guild_id, clicks))
+
+    @staticmethod
+    async def _run(handler, guild_id, clicks):
+        try:
+            await handler(guild_id, clicks)
+        except Exception as e:
+            print(f'Ignoring exception in reaction handler {handler.__name__}:')
+            traceback.print_exception(type(e), e, e.__traceback__)
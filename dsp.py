@@ -0,0 +1,108 @@
+try:
+    import numpy
+except ImportError:
+    # 沒裝 numpy 的話 Mixer 照舊用 audioop 一格一格調音量
+    numpy = None
+
+NUMPY = numpy is not None
+FRAME_SAMPLES = 960  # 20ms 的 48kHz，每個聲道
+
+_index = None  # 1, 2, 3... 每個 PCMStage 共用，只會變長
+
+
+def _ramp_index(size):
+    global _index
+    if _index is None or len(_index) < size:
+        _index = numpy.arange(1, size + 1, dtype=numpy.float32).reshape(size, 1)
+    return _index
+
+
+class PCMStage:
+    """Volume, bass boost and a limiter for 16-bit stereo PCM, a block of frames at a time.
+
+    Set `volume` whenever; the next block moves from the old gain to the new
+    one sample by sample, so changes don't click. *bass* is a low-shelf boost
+    in dB: the low band is a *taps* long moving average (an FIR low-pass,
+    about 450 Hz at 48 taps) added back on top of the signal. *limiter* is
+    the peak ceiling as a fraction of full scale; the gain comes down within
+    the block that would go over it (at once, not ramped) and recovers by
+    *release* per block.
+
+    Every array is allocated once for *frames* frames, process() only
+    writes into them: the float work buffer, the int16 output (whose memory
+    also holds the gain ramp) and, with bass, the filter's own buffers.
+    Below 5 frames a block the numpy overhead per call is more than what
+    audioop costs per frame.
+    """
+
+    def __init__(self, *, frames=5, volume=1.0, bass=0.0, limiter=None, release=0.05, taps=48):
+        size = frames * FRAME_SAMPLES
+        self.frames = frames
+        self.volume = volume
+        self.bass = bass
+        self.limiter = limiter
+        self.release = release
+        self._applied = volume  # 上一塊最後一個 sample 的增益
+        self._reduction = 1.0
+        self._work = numpy.empty((size, 2), numpy.float32)
+        self._out = numpy.empty((size, 2), numpy.int16)
+        # 漸變的增益用完才寫輸出，兩個共用同一塊記憶體
+        self._ramp = self._out.view(numpy.float32)
+        self._index = _ramp_index(size)
+        if bass:
+            self._scratch = numpy.empty((size, 2), numpy.float32)
+            self._taps = taps
+            self._boost = 10 ** (bass / 20) - 1
+            # 前面留 taps 個上一塊的 sample，濾波器才接得起來
+            self._padded = numpy.zeros((size + taps, 2), numpy.float32)
+            self._sums = numpy.empty((size + taps + 1, 2), numpy.float32)
+            self._sums[0] = 0
+
+    def _shelf(self, work, count):
+        taps = self._taps
+        padded = self._padded
+        padded[taps:taps + count] = work
+        sums = self._sums[:taps + count + 1]
+        numpy.cumsum(padded[:taps + count], axis=0, out=sums[1:])
+        low = self._scratch[:count]
+        numpy.subtract(sums[taps + 1:], sums[1:count + 1], out=low)
+        low *= self._boost / taps
+        work += low
+        padded[:taps] = padded[count:count + taps]
+
+    def process(self, data):
+        """*data* (whole frames, at most `frames` of them) with the effects applied."""
+        count = len(data) // 4
+        work = self._work[:count]
+        work[...] = numpy.frombuffer(data, numpy.int16, count * 2).reshape(count, 2)
+        if self.bass:
+            self._shelf(work, count)
+
+        target = self.volume
+        if self.limiter is not None:
+            peak = max(work.max(), -work.min()) * target
+            ceiling = self.limiter * 32767
+            reduction = min(1.0, ceiling / peak) if peak else 1.0
+            attack = reduction < self._reduction
+            if not attack:
+                reduction = min(reduction, self._reduction + self.release)
+            self._reduction = reduction
+            target *= reduction
+
+        start = self._applied
+        if self.limiter is not None and attack:
+            # 要壓下來的時候不能慢慢來，不然這一塊前面還是會爆
+            start = min(start, target)
+        if start == target:
+            work *= target
+        else:
+            ramp = self._ramp[:count]
+            numpy.multiply(self._index[:count], (target - start) / count, out=ramp)
+            ramp += start
+            work *= ramp
+        self._applied = target
+
+        numpy.clip(work, -32768, 32767, out=work)
+        out = self._out[:count]
+        numpy.copyto(out, work, casting='unsafe')
+        return out.tobytes()
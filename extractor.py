@@ -0,0 +1,197 @@
+import asyncio
+import contextlib
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from youtube_dl import YoutubeDL
+
+
+def ytdl_options(directory):
+    """youtube-dl options for the workers, saving into *directory*."""
+    return {
+        'format': 'bestaudio/best',
+        'outtmpl': directory + '/%(extractor)s-%(id)s.%(ext)s',
+        'restrictfilenames': True,
+        'noplaylist': True,
+        'nocheckcertificate': True,
+        'ignoreerrors': False,
+        'logtostderr': False,
+        'quiet': True,
+        'geo-bypass': True,
+        'no_warnings': False,
+        'default_search': 'auto',
+        'cachedir': False,
+    }
+
+
+class ExtractionError(Exception):
+    """youtube-dl failed in a worker process."""
+
+
+class ExtractionTimeout(ExtractionError):
+    """The worker took longer than the timeout and was killed."""
+
+
+def _download(ytdl, data, file_url, job):
+    """Download *data* to *file_url* through a name no other job writes to."""
+    # 用文字搜尋的兩班可能是同一首歌，各自先寫到自己的暫存檔，寫完再換上去，
+    # 正在播的檔案不會被寫到一半
+    template = ytdl.params['outtmpl']
+    ytdl.params['outtmpl'] = f'{template}.{os.getpid()}-{job}.tmp'
+    try:
+        temp = ytdl.prepare_filename(data)
+        try:
+            ytdl.process_info(data)
+            os.replace(temp, file_url)
+        except BaseException:
+            for leftover in (temp, temp + '.part'):
+                with contextlib.suppress(OSError):
+                    os.remove(leftover)
+            raise
+    finally:
+        ytdl.params['outtmpl'] = template
+
+
+def _work(conn, options, fields):
+    """Worker process: one YoutubeDL per process, one job at a time."""
+    ytdl = YoutubeDL(options)
+    jobs = itertools.count()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        search, download = job
+        try:
+            data = ytdl.extract_info(search, download=False)
+            if 'entries' in data:
+                # take first item from a playlist
+                data = data['entries'][0]
+            file_url = ytdl.prepare_filename(data)
+            if download and not os.path.exists(file_url):
+                _download(ytdl, data, file_url, next(jobs))
+            result = (True, {field: data.get(field) for field in fields}, file_url)
+        except Exception as e:
+            # youtube-dl 的例外不一定能 pickle，只傳訊息回去
+            result = (False, str(e), None)
+        conn.send(result)
+
+
+class _Worker:
+    def __init__(self, context, options, fields):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_work, args=(child, options, fields), daemon=True)
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        self.process.kill()
+        self.conn.close()
+        self.process.join(1)
+
+
+class ExtractionPool:
+    """youtube-dl runs in its own processes instead of the bot's default executor.
+
+    A slow or hung extraction only occupies one worker, gets killed after
+    *timeout* seconds and is replaced by a fresh process, and the parsing
+    doesn't hold the GIL the voice threads need.
+    """
+
+    def __init__(self, directory, *, workers=3, timeout=120, fields=('id', 'title', 'webpage_url')):
+        self.directory = directory
+        self.options = ytdl_options(directory)
+        self.workers = workers
+        self.timeout = timeout
+        self.fields = tuple(fields)
+        # 不能用 fork，bot 這時候已經有別的 thread 在跑了
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = None
+        self._all = []
+        # conn.recv() 會卡住，每個 worker 配一個 thread 等結果
+        self._threads = ThreadPoolExecutor(workers, thread_name_prefix='extract')
+
+        self.waiting = 0
+        self.busy = 0
+        self.done = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    def start(self):
+        self._idle = asyncio.Queue()
+        for _ in range(self.workers):
+            self._idle.put_nowait(self._spawn())
+        return self
+
+    def _spawn(self):
+        worker = _Worker(self._context, self.options, self.fields)
+        self._all.append(worker)
+        return worker
+
+    def _replace(self, worker):
+        worker.kill()
+        self._all.remove(worker)
+        return self._spawn()
+
+    async def extract(self, search, *, download=True, timeout=None):
+        """Return (info, file name) for *search*, like YoutubeDL.extract_info.
+
+        Raises ExtractionError when youtube-dl fails and ExtractionTimeout when
+        the job takes too long. Cancelling the call kills the job.
+        """
+        self.waiting += 1
+        try:
+            worker = await self._idle.get()
+        finally:
+            self.waiting -= 1
+        self.busy += 1
+        loop = asyncio.get_event_loop()
+        try:
+            worker.conn.send((search, download))
+            ok, data, file_url = await asyncio.wait_for(
+                loop.run_in_executor(self._threads, worker.conn.recv), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            worker = self._replace(worker)
+            raise ExtractionTimeout(f'youtube-dl took more than {timeout or self.timeout}s for {search}')
+        except asyncio.CancelledError:
+            worker = self._replace(worker)
+            raise
+        except (EOFError, OSError) as e:
+            # worker 自己掛了
+            self.failed += 1
+            worker = self._replace(worker)
+            raise ExtractionError(f'youtube-dl worker died: {e}')
+        finally:
+            self.busy -= 1
+            self._idle.put_nowait(worker)
+        if not ok:
+            self.failed += 1
+            raise ExtractionError(data)
+        self.done += 1
+        return data, file_url
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'busy': self.busy,
+            'waiting': self.waiting,
+            'done': self.done,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+        }
+
+    def close(self):
+        for worker in self._all:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(1)
+            if worker.process.is_alive():
+                worker.process.kill()
+        self._threads.shutdown(wait=False)
@@ -0,0 +1,154 @@
+import collections
+import json
+import time
+
+from writebehind import WriteBehind, replace_file
+
+
+class PlayHistory:
+    """What was played, when, by whom.
+
+    Every finished song is one line in an append-only log (history.jsonl),
+    written in batches from a background thread. The counters behind
+    !stats are updated as events come in and saved next to the log with the
+    log size they cover, so startup only replays the lines after that.
+    """
+
+    def __init__(self, path='history.jsonl', *, flush_delay=30.0):
+        self.path = path
+        self.stats_path = path + '.stats'
+        self.flush_delay = flush_delay
+        self.tracks = collections.Counter()
+        self.titles = {}
+        self.last_played = {}
+        self.users = collections.Counter()
+        self.user_tracks = collections.defaultdict(collections.Counter)
+        self.user_seconds = collections.Counter()
+        self.skips = collections.Counter()
+        self.guilds = collections.Counter()
+        self.total = 0
+
+        self._pending = []
+        self._unwritten = []  # 上次寫失敗的行，只有寫的 thread 會碰
+        self._saver = WriteBehind(self.stats_path, self._snapshot, delay=flush_delay, write=self._write)
+
+    # ------------------------------------------------------------------
+    # loading
+
+    def load(self):
+        try:
+            with open(self.stats_path, 'r', encoding='utf8') as f:
+                stats = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            stats = {'offset': 0}
+        self.tracks.update(stats.get('tracks', {}))
+        self.titles.update(stats.get('titles', {}))
+        self.last_played.update(stats.get('last_played', {}))
+        self.users.update(stats.get('users', {}))
+        for user, tracks in stats.get('user_tracks', {}).items():
+            self.user_tracks[user].update(tracks)
+        self.user_seconds.update(stats.get('user_seconds', {}))
+        self.skips.update(stats.get('skips', {}))
+        self.guilds.update({int(k): v for k, v in stats.get('guilds', {}).items()})
+        self.total = stats.get('total', 0)
+
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(stats['offset'])
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        self._count(json.loads(line))
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return self
+
+    # ------------------------------------------------------------------
+    # recording
+
+    def start(self, guild_id, song_id, title, requester):
+        """Call when a song starts. Pass the returned event to end()."""
+        return {'guild': guild_id, 'id': song_id, 'title': title, 'requester': requester,
+                'start': time.time()}
+
+    def end(self, event, *, skipped=False):
+        """Call when the song stopped playing."""
+        event['end'] = time.time()
+        event['skipped'] = skipped
+        self._count(event)
+        self._pending.append(json.dumps(event, ensure_ascii=False) + '\n')
+        self._saver.changed()
+
+    def _count(self, event):
+        song_id, requester = event['id'], event['requester']
+        self.total += 1
+        self.guilds[event['guild']] += 1
+        self.users[requester] += 1
+        self.user_seconds[requester] += event['end'] - event['start']
+        if event['skipped']:
+            self.skips[requester] += 1
+        if song_id is not None:
+            self.tracks[song_id] += 1
+            self.titles[song_id] = event['title']
+            self.last_played[song_id] = event['start']
+            self.user_tracks[requester][song_id] += 1
+
+    # ------------------------------------------------------------------
+    # queries, all from the counters
+
+    def top(self, n=10):
+        """The *n* most played songs as (song id, title, plays)."""
+        return [(song_id, self.titles.get(song_id), plays) for song_id, plays in self.tracks.most_common(n)]
+
+    def user(self, requester, n=5):
+        return {
+            'plays': self.users[requester],
+            'skips': self.skips[requester],
+            'seconds': self.user_seconds[requester],
+            'top': [(song_id, self.titles.get(song_id), plays)
+                    for song_id, plays in self.user_tracks[requester].most_common(n)]
+                   if requester in self.user_tracks else [],
+        }
+
+    def weight(self, song_id):
+        """Sampling weight: played songs come up more, but not right after they played."""
+        weight = 1.0 + self.tracks[song_id]
+        last = self.last_played.get(song_id)
+        if last is not None and time.time() - last < 6 * 3600:
+            weight /= 4
+        return weight
+
+    # ------------------------------------------------------------------
+    # writing
+
+    def _snapshot(self):
+        # 在 event loop 上只複製一層，json.dumps 留給寫檔的 thread
+        lines, self._pending = self._pending, []
+        stats = {
+            'total': self.total,
+            'tracks': dict(self.tracks),
+            'titles': dict(self.titles),
+            'last_played': dict(self.last_played),
+            'users': dict(self.users),
+            'user_tracks': {user: dict(tracks) for user, tracks in self.user_tracks.items()},
+            'user_seconds': dict(self.user_seconds),
+            'skips': dict(self.skips),
+            'guilds': dict(self.guilds),
+        }
+        return lines, stats
+
+    def _write(self, data):
+        lines, stats = data
+        self._unwritten += lines
+        with open(self.path, 'ab') as f:
+            f.write(''.join(self._unwritten).encode('utf8'))
+            offset = f.tell()
+        self._unwritten = []
+        # 先寫 log 再寫統計，當機的話頂多重算一次 log 的尾巴
+        replace_file(self.stats_path, json.dumps(dict(stats, offset=offset), ensure_ascii=False))
+
+    def close(self):
+        self._saver.close()
@@ -0,0 +1,136 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+# Discord 一次只讓一個 shard 登入，每個 shard 之間要隔 5 秒
+IDENTIFY_DELAY = 5
+# worker 掛掉之後等多久重開，一直掛的話越等越久
+RESTART_DELAY = 5
+MAX_RESTART_DELAY = 300
+# 跑超過這麼久才掛掉的話，重開的等待時間從頭算
+STABLE_AFTER = 600
+
+
+def recommended_shards(token):
+    """How many shards Discord wants this bot to use."""
+    request = urllib.request.Request('https://discord.com/api/v8/gateway/bot',
+                                     headers={'Authorization': f'Bot {token}', 'User-Agent': 'DiscordBot'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())['shards']
+
+
+def partition(shards, workers):
+    """Shard ids 0..shards-1 dealt out to *workers* workers as evenly as possible."""
+    return [list(range(worker, shards, workers)) for worker in range(workers)]
+
+
+class Worker:
+    def __init__(self, worker_id, shard_ids):
+        self.id = worker_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started = 0.0
+        self.delay = RESTART_DELAY
+        self.restart_at = None
+
+
+class Launcher:
+    """Runs one bot.py process per worker and keeps them running.
+
+    Each worker gets its own shards, so every guild (and its player, queue
+    and voice connection) lives in exactly one process, and the workers
+    don't share a GIL. The custom playlist is the shared song.db; everything
+    else a worker saves goes to its own files (downloads.1/, history.1.jsonl...).
+    """
+
+    def __init__(self, workers, shards):
+        self.shards = shards
+        self.workers = [Worker(worker_id, shard_ids)
+                        for worker_id, shard_ids in enumerate(partition(shards, workers))]
+        self.stopping = False
+
+    def _start(self, worker):
+        env = dict(os.environ,
+                   BOT_SHARD_IDS=','.join(map(str, worker.shard_ids)),
+                   BOT_SHARD_COUNT=str(self.shards),
+                   BOT_WORKER_ID=str(worker.id),
+                   BOT_WORKERS=str(len(self.workers)))
+        # 自己一個 process group，Ctrl+C 只會由 stop() 轉給 worker 一次
+        worker.process = subprocess.Popen([sys.executable, 'bot.py'], env=env, start_new_session=True)
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        print(f'worker {worker.id}: pid {worker.process.pid}, shards {worker.shard_ids}')
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        try:
+            for worker in self.workers:
+                if self.stopping:
+                    break
+                self._start(worker)
+                # 等這個 worker 的 shard 都登入了再開下一個
+                time.sleep(IDENTIFY_DELAY * len(worker.shard_ids))
+            while not self.stopping:
+                self._watch()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _watch(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self._start(worker)
+                continue
+            code = worker.process.poll()
+            if code is None:
+                continue
+            if now - worker.started > STABLE_AFTER:
+                worker.delay = RESTART_DELAY
+            print(f'worker {worker.id} exited with {code}, restarting in {worker.delay}s')
+            worker.restart_at = now + worker.delay
+            worker.delay = min(worker.delay * 2, MAX_RESTART_DELAY)
+
+    def stop(self, *_):
+        if self.stopping:
+            return
+        self.stopping = True
+        running = [worker.process for worker in self.workers
+                   if worker.process is not None and worker.process.poll() is None]
+        for process in running:
+            # bot.py 收到 SIGINT 會正常收尾 (存歌單、統計)
+            process.send_signal(signal.SIGINT)
+        for process in running:
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == '__main__':
+    # python launcher.py <workers> [shards]
+    if len(sys.argv) not in (2, 3):
+        sys.exit('usage: python launcher.py <workers> [shards]')
+    workers = int(sys.argv[1])
+    if workers > 1 and not os.path.exists('song.db'):
+        sys.exit('多個 worker 要共用歌單，請先用 python library.py song.json song.db 轉成 SQLite')
+    if len(sys.argv) == 3:
+        shards = int(sys.argv[2])
+    else:
+        with open('key.txt', 'r') as f:
+            key = f.read().strip()
+        try:
+            shards = recommended_shards(key)
+        except (OSError, ValueError, KeyError) as e:
+            print(f'could not ask Discord for the shard count ({e}), using one shard per worker')
+            shards = workers
+    Launcher(workers, max(shards, workers)).run()
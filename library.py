@@ -0,0 +1,561 @@
+import asyncio
+import glob
+import json
+import os
+import random
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from writebehind import WriteBehind
+
+LOAD_SECONDS = metrics.Histogram('library_load_seconds', 'Time to open the custom playlist', ['backend'])
+SAVE_SECONDS = metrics.Histogram('library_save_seconds',
+                                 'Time to write song.json, or to commit one change to song.db', ['backend'])
+
+
+class SongLibrary:
+    """The custom playlist (song.json) kept in memory and shared by every guild.
+
+    Every library backend has the same interface: len/in, get, at, ids,
+    items, titles, find_title, by_requester, sample, is_banned, add, remove,
+    remove_at, update, ban, flush and close. Songs are returned as copies
+    with their YouTube id under 'id', so callers may change them freely.
+    Functions in `listeners` are called with (op, song_id, song) after every
+    add, remove and update, and `version` goes up by one.
+
+    Lookups never touch the disk. Every change is appended to a journal right
+    away and the whole file is rewritten later in a background thread, so a
+    burst of !play only costs one write.
+    """
+
+    def __init__(self, path='song.json', *, flush_delay=10.0):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._songs = {}
+        self._order = []
+        self._ban = []
+        self._ban_set = set()
+        self._extra = {}
+        self.listeners = []
+        self.version = 0
+
+        self._journal = None
+        self._segment = 0
+        self._saver = WriteBehind(path, self._rotate, delay=flush_delay, write=self._write)
+
+    # ------------------------------------------------------------------
+    # loading / journal
+
+    def _segments(self):
+        """Journal segments on disk, oldest first."""
+        found = []
+        for name in glob.glob(glob.escape(self.path) + '.journal.*'):
+            suffix = name.rsplit('.', 1)[1]
+            if suffix.isdigit():
+                found.append((int(suffix), name))
+        return sorted(found)
+
+    def load(self):
+        """Read song.json and replay any journal left by a crash."""
+        try:
+            with open(self.path, 'r', encoding='utf8') as f:
+                data = json.loads(f.read())
+        except FileNotFoundError:
+            data = {'song': {}, 'ban': []}
+
+        self._songs = dict(data.pop('song', {}))
+        self._order = list(self._songs)
+        self._ban = list(data.pop('ban', []))
+        self._ban_set = set(self._ban)
+        self._extra = data
+
+        segments = self._segments()
+        replayed = 0
+        for _, name in segments:
+            with open(name, 'r', encoding='utf8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 寫到一半就掛掉的最後一行
+                        break
+                    self._apply(entry)
+                    replayed += 1
+        self._segment = segments[-1][0] + 1 if segments else 0
+        self._open_journal()
+        if replayed:
+            self._saver.changed()
+        return self
+
+    def _open_journal(self):
+        self._journal = open(f'{self.path}.journal.{self._segment}', 'a', encoding='utf8')
+
+    def _apply(self, entry):
+        op = entry['op']
+        if op == 'add':
+            if entry['id'] not in self._songs:
+                self._order.append(entry['id'])
+            self._songs[entry['id']] = entry['song']
+        elif op == 'remove':
+            if self._songs.pop(entry['id'], None) is not None:
+                self._order.remove(entry['id'])
+        elif op == 'update':
+            if entry['id'] in self._songs:
+                self._songs[entry['id']] = dict(self._songs[entry['id']], **entry['fields'])
+        elif op == 'ban':
+            if entry['user'] not in self._ban_set:
+                self._ban_set.add(entry['user'])
+                self._ban.append(entry['user'])
+
+    def _notify(self, op, song_id, song):
+        self.version += 1
+        for listener in self.listeners:
+            listener(op, song_id, song)
+
+    def _record(self, entry):
+        self._apply(entry)
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._journal.flush()
+        self._saver.changed()
+
+    # ------------------------------------------------------------------
+    # lookups
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __contains__(self, song_id):
+        return song_id in self._songs
+
+    def get(self, song_id):
+        """Return a copy of the song, with its id, or None."""
+        song = self._songs.get(song_id)
+        if song is None:
+            return None
+        return dict(song, id=song_id)
+
+    def at(self, number):
+        """Return the song at 1-based position *number*."""
+        if number < 1:
+            raise IndexError(number)
+        return self.get(self._order[number - 1])
+
+    def ids(self):
+        return list(self._order)
+
+    def titles(self, start, count):
+        """(position, title) of *count* songs from 1-based position *start*."""
+        ids = self._order[max(start, 1) - 1:max(start, 1) - 1 + count]
+        return [(number, self._songs[song_id]['title']) for number, song_id in enumerate(ids, max(start, 1))]
+
+    def items(self):
+        for song_id in self._order:
+            yield song_id, self._songs[song_id]
+
+    def find_title(self, title):
+        """Return the first song whose title is exactly *title*, or None."""
+        for song_id in self._order:
+            if self._songs[song_id]['title'] == title:
+                return self.get(song_id)
+        return None
+
+    def by_requester(self, requester):
+        return [self.get(i) for i in self._order if self._songs[i].get('requester') == requester]
+
+    def sample(self, k):
+        """Return up to *k* distinct random songs."""
+        return [self.get(i) for i in random.sample(self._order, min(k, len(self._order)))]
+
+    def is_banned(self, user_id):
+        return user_id in self._ban_set
+
+    # ------------------------------------------------------------------
+    # mutations
+
+    def add(self, song_id, song):
+        """Add a song if it is not in the library yet. Returns True if added."""
+        if song_id in self._songs:
+            return False
+        self._record({'op': 'add', 'id': song_id, 'song': dict(song)})
+        self._notify('add', song_id, self.get(song_id))
+        return True
+
+    def remove(self, song_id):
+        """Remove a song and return it. Raises KeyError if it isn't there."""
+        song = self.get(song_id)
+        if song is None:
+            raise KeyError(song_id)
+        self._record({'op': 'remove', 'id': song_id})
+        self._notify('remove', song_id, song)
+        return song
+
+    def remove_at(self, number):
+        return self.remove(self.at(number)['id'])
+
+    def update(self, song_id, **fields):
+        """Change some fields of a song. Returns False if nothing changed."""
+        song = self._songs.get(song_id)
+        if song is None or all(song.get(k) == v for k, v in fields.items()):
+            return False
+        self._record({'op': 'update', 'id': song_id, 'fields': fields})
+        self._notify('update', song_id, self.get(song_id))
+        return True
+
+    def ban(self, user_id):
+        if user_id in self._ban_set:
+            return False
+        self._record({'op': 'ban', 'user': user_id})
+        return True
+
+    # ------------------------------------------------------------------
+    # write-behind
+
+    def _rotate(self):
+        """Take a snapshot of the library and start a new journal segment.
+
+        Everything in the segments up to the returned number is contained in
+        the snapshot, so they may be deleted once it is on disk.
+        """
+        data = dict(self._extra)
+        data['song'] = dict(self._songs)
+        data['ban'] = list(self._ban)
+        self._journal.close()
+        covered = self._segment
+        self._segment += 1
+        self._open_journal()
+        return data, covered
+
+    def _write(self, snapshot):
+        data, covered = snapshot
+        tmp = self.path + '.tmp'
+        with SAVE_SECONDS.time(backend='json'):
+            with open(tmp, 'w', encoding='utf8') as f:
+                json.dump(data, f, indent=4, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        for number, name in self._segments():
+            if number <= covered:
+                os.remove(name)
+
+    def refresh(self):
+        """song.json belongs to one process, nobody else changes it."""
+        return 0
+
+    async def flush(self):
+        """Write song.json in a background thread if anything changed."""
+        # 寫失敗的話 journal 還在，WriteBehind 下次再寫
+        await self._saver.flush()
+
+    def close(self):
+        """Flush synchronously. Used on shutdown, after the loop has stopped."""
+        self._saver.close()
+        self._journal.close()
+        if os.path.getsize(self._journal.name) == 0:
+            os.remove(self._journal.name)
+
+
+class SqliteLibrary:
+    """The custom playlist stored in SQLite (WAL mode).
+
+    Same interface as SongLibrary. Songs are indexed by id, by position
+    (insertion order, kept dense so `!pl play N` is an index lookup), by
+    title and by requester, and the ban list is a primary key lookup.
+
+    Several bot processes can share one database. Triggers write every
+    added, changed or removed song to a change log, and refresh() replays
+    the entries this process hasn't seen to the listeners, whoever made
+    them, so in-memory indexes stay in sync across processes.
+
+    Lookups run on the caller's connection. Changes go to one writer thread
+    with its own connection, so waiting for another process's write lock
+    never blocks the event loop. add/remove/update/ban answer from what the
+    library holds now and return before the change is written; the
+    listeners hear about it once it is, and flush() waits for all of them.
+    """
+
+    # 最多留幾筆變更紀錄，每個 process 幾秒就會讀一次，不用留太多
+    KEEP_CHANGES = 10000
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS song (
+        id TEXT PRIMARY KEY,
+        pos INTEGER NOT NULL UNIQUE,
+        title TEXT NOT NULL,
+        requester TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS song_title ON song (title);
+    CREATE INDEX IF NOT EXISTS song_requester ON song (requester);
+    CREATE TABLE IF NOT EXISTS ban (user INTEGER PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS change (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        op TEXT NOT NULL,
+        id TEXT NOT NULL,
+        title TEXT
+    );
+    CREATE TRIGGER IF NOT EXISTS song_added AFTER INSERT ON song
+    BEGIN INSERT INTO change (op, id, title) VALUES ('add', new.id, new.title); END;
+    CREATE TRIGGER IF NOT EXISTS song_updated AFTER UPDATE OF title, requester, data ON song
+    BEGIN INSERT INTO change (op, id, title) VALUES ('update', new.id, new.title); END;
+    CREATE TRIGGER IF NOT EXISTS song_removed AFTER DELETE ON song
+    BEGIN INSERT INTO change (op, id, title) VALUES ('remove', old.id, old.title); END;
+    """
+
+    def __init__(self, path='song.db'):
+        self.path = path
+        self.listeners = []
+        self.version = 0
+        self._db = None
+        self._seen = 0
+        self._data_version = None
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='song-db')
+        self._writer_db = None  # 只在 writer thread 裡用
+
+    def load(self):
+        self._db = sqlite3.connect(self.path)
+        # 別的 process 正在寫的話等一下，不要直接丟 database is locked
+        self._db.execute('PRAGMA busy_timeout=5000')
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(self.SCHEMA)
+        self._seen = self._db.execute('SELECT COALESCE(MAX(seq), 0) FROM change').fetchone()[0]
+        self._data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+        return self
+
+    def refresh(self):
+        """Tell the listeners about songs other processes changed. Returns how many."""
+        # data_version 只有別的連線寫入時才會變，沒變就不用查
+        data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return 0
+        self._data_version = data_version
+        return self._replay()
+
+    def _replay(self):
+        changes = self._db.execute('SELECT seq, op, id, title FROM change WHERE seq > ? ORDER BY seq',
+                                   (self._seen,)).fetchall()
+        for seq, op, song_id, title in changes:
+            self._seen = seq
+            song = {'id': song_id, 'title': title} if op == 'remove' else self.get(song_id)
+            if song is None:
+                # 之後又被刪掉了，等一下的 remove 會處理
+                continue
+            self._notify(op, song_id, song)
+        if changes and changes[-1][0] // 1000 > (changes[0][0] - 1) // 1000:
+            # 每過一千筆清一次舊的
+            self._write(self._trim, changes[-1][0] - self.KEEP_CHANGES)
+        return len(changes)
+
+    # ------------------------------------------------------------------
+    # writer thread
+
+    def _write(self, work, *args):
+        """Run *work(db, *args)* in the writer thread, then replay the change on this loop."""
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            loop = None
+
+        def done(future):
+            error = future.exception()
+            if error is not None:
+                print(f'song.db write failed: {error}')
+            elif loop is not None and not loop.is_closed():
+                loop.call_soon_threadsafe(self._replay)
+
+        future = self._writer.submit(self._run, work, args)
+        future.add_done_callback(done)
+        return future
+
+    def _run(self, work, args):
+        if self._writer_db is None:
+            self._writer_db = sqlite3.connect(self.path)
+            self._writer_db.execute('PRAGMA busy_timeout=5000')
+            self._writer_db.execute('PRAGMA synchronous=NORMAL')
+        with SAVE_SECONDS.time(backend='sqlite'), self._writer_db:
+            work(self._writer_db, *args)
+
+    @staticmethod
+    def _insert(db, song_id, song):
+        db.execute('INSERT OR IGNORE INTO song (id, pos, title, requester, data) '
+                   'SELECT ?, COALESCE(MAX(pos), 0) + 1, ?, ?, ? FROM song',
+                   (song_id, song['title'], song.get('requester'), json.dumps(song, ensure_ascii=False)))
+
+    @staticmethod
+    def _delete(db, song_id):
+        row = db.execute('SELECT pos FROM song WHERE id = ?', (song_id,)).fetchone()
+        if row is None:
+            return
+        db.execute('DELETE FROM song WHERE id = ?', (song_id,))
+        # 讓位置保持連續。先變成負數再翻回來，避免 UNIQUE 在更新途中衝突
+        db.execute('UPDATE song SET pos = 1 - pos WHERE pos > ?', (row[0],))
+        db.execute('UPDATE song SET pos = -pos WHERE pos < 0')
+
+    @staticmethod
+    def _change(db, song_id, fields):
+        # 在這裡才讀出來改，兩個很接近的 update 不會互相蓋掉
+        row = db.execute('SELECT data FROM song WHERE id = ?', (song_id,)).fetchone()
+        if row is None:
+            return
+        song = json.loads(row[0])
+        if all(song.get(k) == v for k, v in fields.items()):
+            return
+        song.update(fields)
+        db.execute('UPDATE song SET title = ?, requester = ?, data = ? WHERE id = ?',
+                   (song['title'], song.get('requester'), json.dumps(song, ensure_ascii=False), song_id))
+
+    @staticmethod
+    def _ban(db, user_id):
+        db.execute('INSERT OR IGNORE INTO ban (user) VALUES (?)', (user_id,))
+
+    @staticmethod
+    def _trim(db, seq):
+        db.execute('DELETE FROM change WHERE seq <= ?', (seq,))
+
+    def _close_writer(self):
+        if self._writer_db is not None:
+            self._writer_db.close()
+            self._writer_db = None
+
+    @staticmethod
+    def _song(row):
+        if row is None:
+            return None
+        song = json.loads(row[1])
+        song['id'] = row[0]
+        return song
+
+    def __len__(self):
+        # 位置是連續的，最大的位置就是總數，走索引不用掃表
+        return self._db.execute('SELECT COALESCE(MAX(pos), 0) FROM song').fetchone()[0]
+
+    def __contains__(self, song_id):
+        return self._db.execute('SELECT 1 FROM song WHERE id = ?', (song_id,)).fetchone() is not None
+
+    def get(self, song_id):
+        return self._song(self._db.execute('SELECT id, data FROM song WHERE id = ?', (song_id,)).fetchone())
+
+    def at(self, number):
+        song = self._song(self._db.execute('SELECT id, data FROM song WHERE pos = ?', (number,)).fetchone())
+        if song is None:
+            raise IndexError(number)
+        return song
+
+    def ids(self):
+        return [row[0] for row in self._db.execute('SELECT id FROM song ORDER BY pos')]
+
+    def titles(self, start, count):
+        return self._db.execute('SELECT pos, title FROM song WHERE pos >= ? AND pos < ? ORDER BY pos',
+                                (start, start + count)).fetchall()
+
+    def items(self):
+        for song_id, data in self._db.execute('SELECT id, data FROM song ORDER BY pos'):
+            yield song_id, json.loads(data)
+
+    def find_title(self, title):
+        return self._song(self._db.execute(
+            'SELECT id, data FROM song WHERE title = ? ORDER BY pos LIMIT 1', (title,)).fetchone())
+
+    def by_requester(self, requester):
+        rows = self._db.execute('SELECT id, data FROM song WHERE requester = ? ORDER BY pos', (requester,))
+        return [self._song(row) for row in rows]
+
+    def sample(self, k):
+        # 直接抽位置就好，不用把整個歌單讀出來
+        total = len(self)
+        picks = random.sample(range(1, total + 1), min(k, total))
+        songs = {}
+        for start in range(0, len(picks), 500):
+            chunk = picks[start:start + 500]
+            marks = ','.join('?' * len(chunk))
+            for row in self._db.execute(f'SELECT pos, id, data FROM song WHERE pos IN ({marks})', chunk):
+                songs[row[0]] = self._song(row[1:])
+        return [songs[pos] for pos in picks]
+
+    def _notify(self, op, song_id, song):
+        self.version += 1
+        for listener in self.listeners:
+            listener(op, song_id, song)
+
+    def is_banned(self, user_id):
+        return self._db.execute('SELECT 1 FROM ban WHERE user = ?', (user_id,)).fetchone() is not None
+
+    def add(self, song_id, song):
+        if song_id in self:
+            return False
+        song = dict(song)
+        song.pop('id', None)
+        self._write(self._insert, song_id, song)
+        return True
+
+    def remove(self, song_id):
+        song = self.get(song_id)
+        if song is None:
+            raise KeyError(song_id)
+        self._write(self._delete, song_id)
+        return song
+
+    def remove_at(self, number):
+        return self.remove(self.at(number)['id'])
+
+    def update(self, song_id, **fields):
+        song = self.get(song_id)
+        if song is None or all(song.get(k) == v for k, v in fields.items()):
+            return False
+        self._write(self._change, song_id, fields)
+        return True
+
+    def ban(self, user_id):
+        if self.is_banned(user_id):
+            return False
+        self._write(self._ban, user_id)
+        return True
+
+    async def flush(self):
+        """Wait until every change made so far is in song.db and the listeners know."""
+        await asyncio.wrap_future(self._writer.submit(lambda: None))
+        self._replay()
+
+    def close(self):
+        self._writer.submit(self._close_writer)
+        self._writer.shutdown(wait=True)
+        self._db.close()
+
+
+def open_library(path):
+    """Open the library backend that matches *path* (.db is SQLite, anything else JSON)."""
+    if path.endswith('.db'):
+        with LOAD_SECONDS.time(backend='sqlite'):
+            return SqliteLibrary(path).load()
+    with LOAD_SECONDS.time(backend='json'):
+        return SongLibrary(path).load()
+
+
+def migrate(json_path, db_path):
+    """One-shot copy of a song.json library (and its journal) into SQLite."""
+    source = SongLibrary(json_path).load()
+    target = SqliteLibrary(db_path).load()
+    if len(target):
+        raise ValueError(f'{db_path} already has songs in it')
+    with target._db:
+        target._db.executemany(
+            'INSERT INTO song (id, pos, title, requester, data) VALUES (?, ?, ?, ?, ?)',
+            ((song_id, number, song['title'], song.get('requester'), json.dumps(song, ensure_ascii=False))
+             for number, (song_id, song) in enumerate(source.items(), 1)))
+        target._db.executemany('INSERT OR IGNORE INTO ban (user) VALUES (?)',
+                               ((user,) for user in source._ban))
+        target._db.execute('DELETE FROM change')
+    count = len(target)
+    source.close()
+    target.close()
+    return count
+
+
+if __name__ == '__main__':
+    # python library.py song.json song.db
+    if len(sys.argv) != 3:
+        sys.exit('usage: python library.py <song.json> <song.db>')
+    print(f'{migrate(sys.argv[1], sys.argv[2])} songs in {sys.argv[2]}')
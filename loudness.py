@@ -0,0 +1,157 @@
+import asyncio
+import json
+import math
+import os
+import re
+
+from writebehind import WriteBehind
+
+
+class Loudness:
+    """Measures every downloaded file once and remembers its gain.
+
+    Running loudnorm live costs a lot of CPU for every guild that is playing.
+    Instead each file goes through one analysis pass in the background and
+    playback only applies the resulting gain with FFmpeg's cheap volume
+    filter. Files that haven't been measured yet still use loudnorm.
+    """
+
+    def __init__(self, path='loudness.json', *, target=-16.0, true_peak=-1.5, workers=1):
+        self.path = path
+        self.target = target
+        self.true_peak = true_peak
+        self.gains = {}
+        self._pending = set()
+        self._semaphore = asyncio.Semaphore(workers)
+        self._saver = WriteBehind(path, lambda: json.dumps(self.gains), delay=30)
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf8') as f:
+                self.gains = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            self.gains = {}
+        return self
+
+    def gain(self, file_url):
+        """The gain in dB for *file_url*, or None if it hasn't been measured."""
+        return self.gains.get(file_url)
+
+    def submit(self, file_url):
+        """Measure *file_url* in the background unless it is already known."""
+        if file_url in self.gains or file_url in self._pending:
+            return
+        self._pending.add(file_url)
+        asyncio.get_event_loop().create_task(self._measure(file_url))
+
+    def forget(self, file_url):
+        if self.gains.pop(file_url, None) is not None:
+            self._saver.changed()
+
+    async def _measure(self, file_url):
+        try:
+            async with self._semaphore:
+                proc = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-hide_banner', '-threads', '1', '-i', file_url,
+                    '-vn', '-af', f'loudnorm=I={self.target}:TP={self.true_peak}:LRA=11:print_format=json',
+                    '-f', 'null', '-',
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, err = await proc.communicate()
+            # loudnorm 的結果是 stderr 最後面的一段 JSON
+            found = re.search(r'\{[^{}]*"input_i"[^{}]*\}', err.decode('utf8', 'replace'))
+            if proc.returncode != 0 or found is None:
+                print(f'loudness: could not measure {file_url}')
+                return
+            measured = json.loads(found.group(0))
+            input_i = float(measured['input_i'])
+            input_tp = float(measured['input_tp'])
+            if input_i == float('-inf'):
+                # 整首都是靜音
+                return
+            gain = min(self.target - input_i, self.true_peak - input_tp)
+            self.gains[file_url] = round(max(-30.0, min(gain, 30.0)), 2)
+            self._saver.changed()
+        except (OSError, ValueError) as e:
+            print(f'loudness: {file_url}: {e}')
+        finally:
+            self._pending.discard(file_url)
+
+    def close(self):
+        self._saver.close()
+
+
+class OpusVariants:
+    """Opus copies of downloaded files with the gain and volume already applied.
+
+    Discord wants Opus anyway, so a file that is already Opus at the right
+    loudness can be sent as is: no PCM decoding, no volume scaling in Python
+    and no Opus encoding in the bot process. Volume is baked in at the
+    nearest of LEVELS (youtube-abc.v10.opus is 10%), which means volume
+    changes only apply to passthrough songs from the next song on. A file
+    gets at most *limit* variants; other volumes play through PCM until the
+    audio cache deletes a variant nobody uses.
+    """
+
+    # 百分比，大約每 3 dB 一階，最多差 1.5 dB
+    LEVELS = (1, 2, 3, 5, 7, 10, 14, 20, 28, 40, 56, 80, 100, 140, 200)
+
+    def __init__(self, *, bitrate=128, workers=1, limit=3):
+        self.bitrate = bitrate
+        self.limit = limit
+        self.on_ready = None
+        self._pending = set()
+        self._semaphore = asyncio.Semaphore(workers)
+
+    @classmethod
+    def step(cls, volume):
+        """The level in percent closest to *volume*."""
+        percent = max(volume * 100, cls.LEVELS[0])
+        return min(cls.LEVELS, key=lambda level: abs(math.log(level / percent)))
+
+    @staticmethod
+    def _path(file_url, level):
+        return f'{file_url.rsplit(".", 1)[0]}.v{level}.opus'
+
+    def path(self, file_url, volume):
+        return self._path(file_url, self.step(volume))
+
+    def variants(self, file_url):
+        """How many variants of *file_url* exist or are being encoded."""
+        paths = [self._path(file_url, level) for level in self.LEVELS]
+        return sum(path in self._pending or os.path.exists(path) for path in paths)
+
+    def get(self, file_url, volume):
+        """Path of the ready-made variant, or None."""
+        path = self.path(file_url, volume)
+        return path if os.path.exists(path) else None
+
+    def submit(self, file_url, gain, volume):
+        """Encode the variant for *volume* in the background if it is missing."""
+        path = self.path(file_url, volume)
+        if path in self._pending or os.path.exists(path) or self.variants(file_url) >= self.limit:
+            return
+        self._pending.add(path)
+        asyncio.get_event_loop().create_task(self._encode(file_url, path, gain + 20 * math.log10(self.step(volume) / 100)))
+
+    async def _encode(self, file_url, path, gain):
+        tmp = path + '.tmp'
+        try:
+            async with self._semaphore:
+                proc = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-threads', '1', '-y',
+                    '-i', file_url, '-vn', '-af', f'volume={gain:.2f}dB',
+                    '-c:a', 'libopus', '-b:a', f'{self.bitrate}k', '-ar', '48000', '-ac', '2', '-f', 'opus', tmp,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, err = await proc.communicate()
+            if proc.returncode != 0:
+                print(f'opus: could not encode {file_url}: {err.decode("utf8", "replace").strip()}')
+                return
+            os.replace(tmp, path)
+            if self.on_ready is not None:
+                self.on_ready(file_url, path)
+        except OSError as e:
+            print(f'opus: {file_url}: {e}')
+        finally:
+            self._pending.discard(path)
+            if os.path.exists(tmp):
+                os.remove(tmp)
@@ -0,0 +1,169 @@
+import bisect
+import time
+
+# 秒數，從 5ms 到 2 分鐘
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Registry:
+    """All metrics of the process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'metric {metric.name} already exists')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics.values())
+
+    def reset(self):
+        """Forget everything observed so far (benchmarks start each run from zero)."""
+        for metric in self.metrics.values():
+            metric.reset()
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), *, function=None, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # 有 function 的話抓取時才去問目前的值 (佇列長度、快取用量...)
+        self.function = function
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in pairs) + '}'
+
+    def _samples(self):
+        if self.function is not None:
+            yield f'{self.name} {self.function()}'
+            return
+        for key, value in sorted(self._values.items()):
+            yield f'{self.name}{self._label_text(key)} {value}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        self._values.clear()
+
+    def value(self, **labels):
+        if self.function is not None:
+            return self.function()
+        return self._values.get(self._key(labels), 0)
+
+
+class Counter(_Metric):
+    """A number that only goes up."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A number that goes up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(_Metric):
+    """How long things took, counted into buckets.
+
+    observe() is a bisect and three additions, so it can sit in hot paths.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), *, buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labels, registry=registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            # [每個 bucket 的數量 (最後一個是 +Inf), 總和, 次數]
+            data = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def time(self, **labels):
+        """``with histogram.time():`` observes how long the block took."""
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        data = self._values.get(self._key(labels))
+        return data[2] if data else 0
+
+    def quantile(self, q, **labels):
+        """Estimate the *q* quantile from the buckets, or None without observations."""
+        data = self._values.get(self._key(labels))
+        if not data or not data[2]:
+            return None
+        rank = q * data[2]
+        seen = 0
+        for i, count in enumerate(data[0]):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                low = self.buckets[i - 1] if i else 0.0
+                return low + (self.buckets[i] - low) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def keys(self):
+        """Label values that have observations, as dicts."""
+        return [dict(zip(self.labels, key)) for key in sorted(self._values)]
+
+    def _samples(self):
+        for key, (counts, total, number) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{self._label_text(key, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{self._label_text(key)} {total}'
+            yield f'{self.name}_count{self._label_text(key)} {number}'
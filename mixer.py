@@ -0,0 +1,183 @@
+import audioop
+import collections
+import threading
+
+import discord
+
+# 20ms 的 48kHz 16-bit 雙聲道 PCM
+FRAME_BYTES = 3840
+SILENCE = bytes(FRAME_BYTES)
+
+
+class Mixer(discord.AudioSource):
+    """Plays song after song as one PCM source, so Discord never sees a gap.
+
+    The mixer reads the current song up to *buffer* frames ahead of what it
+    sends. When FFmpeg reaches the end of the file it sets wants_next and
+    calls on_event(), while the buffered tail is still playing; the player
+    then stage()s the next song with its FFmpeg process already running.
+    The last *crossfade* frames of the old song are mixed with the start of
+    the new one; with crossfade 0, or when the next song came in late, the
+    switch is a plain cut at the frame boundary. Without a staged song the
+    mixer ends like any other source.
+
+    Both songs have the player's volume, so the crossfade mixes raw frames
+    and the volume goes on afterwards: frame by frame with audioop, or with
+    a dsp.PCMStage *effects* a block of effects.frames frames at a time.
+
+    Every switch adds one to `switches` and sets `last_gap`: the seconds of
+    silence between the two songs (the padding of the old one's last frame),
+    negative when they overlapped in a crossfade.
+
+    read() runs on the voice thread and everything else on the event loop,
+    so the two meet under a lock. on_event() is called from the voice
+    thread whenever the player should look at the mixer again.
+    """
+
+    def __init__(self, source, *, buffer=50, crossfade=25, on_event=None, effects=None):
+        self.current = source
+        self.next = None
+        self.wants_next = False
+        self.closed = False
+        self.switches = 0
+        self.last_gap = None
+        self.crossfade = crossfade
+        self.buffer = max(buffer, crossfade, 1)
+        self.on_event = on_event
+        self.effects = effects
+        self._ahead = collections.deque()
+        self._ready = collections.deque()  # effects 處理好、還沒送出的格
+        self._eof = False
+        self._fade = 0  # 開始淡出的時候還剩幾格
+        self._padding = 0.0  # 最後一格補了幾秒的靜音
+        self._overlap = 0  # 兩首疊在一起的格數
+        self._lock = threading.Lock()
+
+    @property
+    def volume(self):
+        current = self.current
+        return current.volume if current is not None else 0.0
+
+    @volume.setter
+    def volume(self, value):
+        for source in (self.current, self.next):
+            if source is not None:
+                source.volume = value
+
+    def buffered(self):
+        """Bytes of audio read ahead."""
+        return (len(self._ahead) + len(self._ready)) * FRAME_BYTES
+
+    def _notify(self):
+        if self.on_event is not None:
+            self.on_event()
+
+    def _fill(self):
+        # 一次最多讀兩格，緩衝慢慢補滿，不會一開始就卡住語音執行緒
+        for _ in range(2):
+            if self._eof or len(self._ahead) >= self.buffer:
+                return
+            frame = self.current.original.read()
+            if len(frame) < FRAME_BYTES:
+                self._eof = True
+                if frame:
+                    self._ahead.append(frame + SILENCE[len(frame):])
+                    self._padding = (FRAME_BYTES - len(frame)) / FRAME_BYTES * 0.02
+                self.wants_next = True
+                self._notify()
+            else:
+                self._ahead.append(frame)
+
+    def _switch(self):
+        if self.next is None:
+            return False
+        self.current, self.next = self.next, None
+        self.last_gap = self._padding - self._overlap * 0.02
+        self.switches += 1
+        self._ahead.clear()
+        self._ready.clear()
+        self._eof = False
+        self._fade = 0
+        self._padding = 0.0
+        self._overlap = 0
+        self.wants_next = False
+        self._notify()
+        return True
+
+    def _mix(self):
+        # 下一格還沒調音量的聲音，沒有了就是 b''
+        if self.current is None:
+            return b''
+        self._fill()
+        if not self._ahead:
+            if not self._switch():
+                self.closed = True
+                return b''
+            self._fill()
+            if not self._ahead:
+                # 下一首是空的，這格先放靜音，下一格再看
+                return SILENCE
+        frame = self._ahead.popleft()
+        incoming = self.next
+        if incoming is not None and self._eof and len(self._ahead) < self.crossfade:
+            if not self._fade:
+                self._fade = len(self._ahead) + 1
+            start = incoming.original.read()
+            if len(start) == FRAME_BYTES:
+                # 舊的一首越來越小聲，新的一首越來越大聲
+                left = len(self._ahead) / self._fade
+                frame = audioop.add(audioop.mul(frame, 2, left), audioop.mul(start, 2, 1 - left), 2)
+                self._overlap += 1
+        return frame
+
+    def read(self):
+        with self._lock:
+            if self.effects is None:
+                frame = self._mix()
+                return audioop.mul(frame, 2, min(self.volume, 2.0)) if frame else b''
+            if not self._ready:
+                block = []
+                while len(block) < self.effects.frames:
+                    frame = self._mix()
+                    if not frame:
+                        break
+                    block.append(frame)
+                if not block:
+                    return b''
+                self.effects.volume = min(self.volume, 2.0)
+                data = self.effects.process(b''.join(block))
+                self._ready.extend(data[i:i + FRAME_BYTES] for i in range(0, len(data), FRAME_BYTES))
+            return self._ready.popleft()
+
+    def stage(self, source):
+        """Play *source* right after the current song.
+
+        False when the mixer has ended or is full, or *source* sends Opus
+        packets, which can't be mixed.
+        """
+        if source.is_opus():
+            return False
+        with self._lock:
+            if self.closed or self.current is None or self.next is not None:
+                return False
+            self.next = source
+            return True
+
+    def unstage(self):
+        """Take back the staged song that never started, or None."""
+        with self._lock:
+            source, self.next = self.next, None
+            return source
+
+    def skip(self):
+        """Cut to the staged song now. False when there is none."""
+        with self._lock:
+            return self._switch()
+
+    def cleanup(self):
+        # 語音那邊停了 (播完、!skip 沒有下一首、斷線)，staged 的歌留給 player 放回佇列
+        with self._lock:
+            self.closed = True
+            current = self.current
+        if current is not None:
+            current.cleanup()
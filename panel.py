@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import discord
+
+
+class TokenBucket:
+    """*rate* calls per *per* seconds, with bursts of up to *rate* calls."""
+
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.interval = per / rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) / self.interval)
+        self.updated = now
+
+    async def take(self):
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) * self.interval)
+            self._refill()
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """One token bucket per Discord route and channel.
+
+    discord.py only slows down after Discord answered 429. Waiting for a
+    token first keeps the panels of busy guilds from running into the limit
+    at all, and the reactions of one panel from starving another channel.
+    """
+
+    # route -> (calls, seconds)，大約是 Discord 每個頻道的限制
+    ROUTES = {
+        'send': (5, 5.0),
+        'edit': (5, 5.0),
+        'delete': (5, 1.0),
+        'reaction': (1, 0.25),
+    }
+
+    def __init__(self, routes=None):
+        self.routes = dict(routes or self.ROUTES)
+        self._buckets = {}
+
+    async def wait(self, route, channel_id):
+        bucket = self._buckets.get((route, channel_id))
+        if bucket is None:
+            bucket = self._buckets[route, channel_id] = TokenBucket(*self.routes[route])
+        await bucket.take()
+
+
+class Panel:
+    """The now playing message of one guild.
+
+    Instead of sending a new message with all its buttons for every song,
+    one message is sent, gets its reactions once and is edited in place
+    from then on. show() only records what the message should say; a
+    background task brings Discord up to date, so playback never waits for
+    the API, and several changes in a row end up as a single edit.
+
+    on_change(old id, new id) is called whenever the message is replaced,
+    so reactions can be routed to the right guild.
+    """
+
+    def __init__(self, channel, buttons=(), *, limiter=None):
+        self.channel = channel
+        self.buttons = tuple(buttons)
+        self.limiter = limiter or RateLimiter()
+        self.message = None
+        self.on_change = None
+        self._content = None
+        self._shown = None
+        self._task = None
+
+    @property
+    def message_id(self):
+        return self.message.id if self.message is not None else None
+
+    def _set_message(self, message):
+        old = self.message
+        self.message = message
+        if self.on_change is not None and old is not message:
+            self.on_change(old.id if old is not None else None, message.id if message is not None else None)
+
+    def show(self, content):
+        """Make the panel say *content*. Returns at once."""
+        self._content = content
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._sync())
+
+    def repost(self, channel=None):
+        """Send the panel again at the bottom of *channel*, like !np used to."""
+        old = self.message
+        self._set_message(None)
+        self._shown = None
+        if channel is not None:
+            self.channel = channel
+        if old is not None:
+            asyncio.get_event_loop().create_task(self._delete(old))
+        if self._content is not None:
+            self.show(self._content)
+
+    async def _sync(self):
+        while self._content is not None and self._content != self._shown:
+            content = self._content
+            message = self.message
+            try:
+                if message is None:
+                    await self.limiter.wait('send', self.channel.id)
+                    message = await self.channel.send(content)
+                    self._set_message(message)
+                    self._shown = content
+                    for emoji in self.buttons:
+                        await self.limiter.wait('reaction', self.channel.id)
+                        await message.add_reaction(emoji)
+                else:
+                    await self.limiter.wait('edit', self.channel.id)
+                    await message.edit(content=content)
+                    # 編輯途中被 repost 的話，新的訊息還沒顯示
+                    if self.message is message:
+                        self._shown = content
+            except discord.NotFound:
+                if message is None:
+                    # 頻道不見了
+                    return
+                # 訊息被刪掉了(!stop 會清頻道)，重發一則
+                if self.message is message:
+                    self._set_message(None)
+                    self._shown = None
+            except discord.HTTPException as e:
+                print(f'panel: {e}')
+                return
+
+    async def _delete(self, message):
+        try:
+            await self.limiter.wait('delete', message.channel.id)
+            await message.delete()
+        except discord.HTTPException:
+            pass
+
+    async def close(self):
+        """Stop updating and delete the message."""
+        if self._task is not None:
+            self._task.cancel()
+        self._content = None
+        message = self.message
+        self._set_message(None)
+        if message is not None:
+            await self._delete(message)
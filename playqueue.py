@@ -0,0 +1,313 @@
+import asyncio
+import collections
+import heapq
+import itertools
+
+FORCE = 1
+
+
+class StrictPriority:
+    """Lower priority number first, first come first served within a priority."""
+
+    name = 'strict'
+
+    def key(self, priority, timestamp, owner):
+        return (priority, timestamp)
+
+    def dispatched(self, key):
+        pass
+
+    def reset(self):
+        pass
+
+
+class RoundRobin:
+    """Requesters take turns: everybody's first song, then everybody's second...
+
+    A requester's bulk songs and their own !play are separate turns, so one
+    !pl 50 can't push anybody's interactive request behind 50 songs.
+    """
+
+    name = 'rr'
+
+    def __init__(self):
+        self.reset()
+
+    def key(self, priority, timestamp, owner):
+        if priority <= FORCE:
+            return (float('-inf'), priority, timestamp)
+        flow = owner, priority
+        turn = max(self.turn, self.last.get(flow, -1) + 1)
+        self.last[flow] = turn
+        return (turn, priority, timestamp)
+
+    def dispatched(self, key):
+        if key[0] > self.turn:
+            self.turn = key[0]
+
+    def reset(self):
+        self.turn = 0
+        self.last = {}
+
+
+class WeightedFair:
+    """Weighted fair queuing between requesters.
+
+    Every song gets a virtual finish time: the later of now and the
+    requester's previous song, plus its priority number as the cost. Bulk
+    songs (10) cost twice as much as a !play (5), and each requester's
+    !play and bulk songs are separate flows, so a !play waits for at most
+    a few songs no matter how big the bulk backlog is.
+    """
+
+    name = 'wfq'
+
+    def __init__(self):
+        self.reset()
+
+    def key(self, priority, timestamp, owner):
+        if priority <= FORCE:
+            return (float('-inf'), timestamp)
+        flow = owner, priority
+        finish = max(self.now, self.finish.get(flow, 0.0)) + priority
+        self.finish[flow] = finish
+        return (finish, timestamp)
+
+    def dispatched(self, key):
+        if key[0] > self.now:
+            self.now = key[0]
+
+    def reset(self):
+        self.now = 0.0
+        self.finish = {}
+
+
+SCHEDULERS = {scheduler.name: scheduler for scheduler in (StrictPriority, RoundRobin, WeightedFair)}
+
+
+class PlayQueue:
+    """The song queue of one guild.
+
+    Works like the asyncio.PriorityQueue it replaces: put() takes
+    (priority, timestamp, source) and get() waits for the smallest one. On top
+    of that it can show the next songs in the order they will really play,
+    remove or move a song by its position, drop duplicates and be cleared
+    without replacing the object (player_loop may be waiting on it).
+
+    The order comes from a scheduler (StrictPriority, RoundRobin or
+    WeightedFair) that turns each song's priority, timestamp and owner into
+    a sort key when it is queued.
+
+    Removed songs are only marked as dead and skipped later; the heap is
+    rebuilt once the dead entries outnumber the live ones.
+
+    on_change() is called after every change, so the queue can be saved.
+    """
+
+    # entry: [key, order, uid, priority, timestamp, owner, source, alive]
+    # uid 不會重複，所以 heap 永遠不會去比較 source
+    KEY, ORDER, UID, PRIORITY, TIMESTAMP, OWNER, SOURCE, ALIVE = range(8)
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler or StrictPriority()
+        self._heap = []
+        self._live = 0
+        self._uid = itertools.count()
+        self._ids = collections.Counter()
+        self._getters = collections.deque()
+        self.on_change = None
+
+    @staticmethod
+    def _song_id(source):
+        return source.get('id') if isinstance(source, dict) else None
+
+    @classmethod
+    def _item(cls, entry):
+        return entry[cls.PRIORITY], entry[cls.TIMESTAMP], entry[cls.SOURCE]
+
+    def __len__(self):
+        return self._live
+
+    def qsize(self):
+        return self._live
+
+    def empty(self):
+        return self._live == 0
+
+    def contains(self, song_id):
+        """Whether a song with this id is waiting in the queue."""
+        return self._ids[song_id] > 0
+
+    def items(self):
+        """Every queued (priority, timestamp, source), in no particular order."""
+        return [self._item(entry) for entry in self._heap if entry[self.ALIVE]]
+
+    def snapshot(self):
+        """Every queued (priority, timestamp, owner, source), in the order they will play."""
+        return [(entry[self.PRIORITY], entry[self.TIMESTAMP], entry[self.OWNER], entry[self.SOURCE])
+                for entry in sorted(entry for entry in self._heap if entry[self.ALIVE])]
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    # ------------------------------------------------------------------
+    # put / get
+
+    def _push(self, key, order, priority, timestamp, owner, source):
+        uid = next(self._uid)
+        entry = [key, uid if order is None else order, uid, priority, timestamp, owner, source, True]
+        heapq.heappush(self._heap, entry)
+        self._live += 1
+        self._ids[self._song_id(source)] += 1
+        self._wake()
+        self._changed()
+        return entry
+
+    def put_nowait(self, item, *, owner=None):
+        """Queue (priority, timestamp, source). *owner* is who queued it, for fair scheduling."""
+        priority, timestamp, source = item
+        if owner is None and isinstance(source, dict):
+            owner = source.get('requester')
+        key = self.scheduler.key(priority, timestamp, owner)
+        self._push(key, None, priority, timestamp, owner, source)
+
+    async def put(self, item, *, owner=None):
+        self.put_nowait(item, owner=owner)
+
+    def set_scheduler(self, scheduler):
+        """Switch scheduler and re-key everything queued, in the order it arrived."""
+        self.scheduler = scheduler
+        entries = sorted((entry for entry in self._heap if entry[self.ALIVE]),
+                         key=lambda entry: (entry[self.TIMESTAMP], entry[self.UID]))
+        for entry in entries:
+            entry[self.KEY] = scheduler.key(entry[self.PRIORITY], entry[self.TIMESTAMP], entry[self.OWNER])
+            entry[self.ORDER] = entry[self.UID]
+        self._heap = entries
+        heapq.heapify(self._heap)
+        self._changed()
+
+    def _kill(self, entry):
+        entry[self.ALIVE] = False
+        self._live -= 1
+        song_id = self._song_id(entry[self.SOURCE])
+        self._ids[song_id] -= 1
+        if self._ids[song_id] <= 0:
+            del self._ids[song_id]
+        if len(self._heap) > 64 and len(self._heap) > 2 * self._live:
+            self._heap = [entry for entry in self._heap if entry[self.ALIVE]]
+            heapq.heapify(self._heap)
+        self._changed()
+
+    def get_nowait(self):
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if entry[self.ALIVE]:
+                self._kill(entry)
+                self.scheduler.dispatched(entry[self.KEY])
+                if self._live == 0:
+                    self.scheduler.reset()
+                return self._item(entry)
+        raise asyncio.QueueEmpty
+
+    async def get(self):
+        while self.empty():
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                if getter in self._getters:
+                    self._getters.remove(getter)
+                raise
+        return self.get_nowait()
+
+    def _wake(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                return
+
+    # ------------------------------------------------------------------
+    # ordered access
+
+    def _top(self, k):
+        """The first *k* live entries in play order, O(k log k)."""
+        found = []
+        if k <= 0 or not self._heap:
+            return found
+        # 從 heap 的根往下走，每次拿目前最小的那個，再把它的兩個子節點放進來
+        frontier = [(self._heap[0], 0)]
+        while frontier and len(found) < k:
+            entry, index = heapq.heappop(frontier)
+            if entry[self.ALIVE]:
+                found.append(entry)
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child], child))
+        return found
+
+    def peek(self, k):
+        """The next *k* (priority, timestamp, source) in the order they will play."""
+        return [self._item(entry) for entry in self._top(k)]
+
+    def _entry_at(self, position):
+        if not 1 <= position <= self._live:
+            raise IndexError(position)
+        return self._top(position)[-1]
+
+    def remove(self, position):
+        """Remove the song at 1-based *position* and return its item."""
+        entry = self._entry_at(position)
+        self._kill(entry)
+        return self._item(entry)
+
+    def move(self, position, target):
+        """Move the song at *position* so it becomes song number *target*."""
+        entry = self._entry_at(position)
+        self._kill(entry)
+        target = max(1, min(target, self._live + 1))
+        around = self._top(target)
+        prev = around[target - 2] if target >= 2 else None
+        after = around[target - 1] if len(around) >= target else None
+        K, O = self.KEY, self.ORDER
+        if after is None:
+            if prev is None:
+                key, order = entry[K], entry[O]
+            else:
+                key, order = prev[K], prev[O] + 1
+        elif prev is None or prev[K] != after[K]:
+            # 排在 after 前面就好，中間不可能有別的歌
+            key, order = after[K], after[O] - 1
+        else:
+            key, order = after[K], (prev[O] + after[O]) / 2
+        self._push(key, order, entry[self.PRIORITY], entry[self.TIMESTAMP], entry[self.OWNER], entry[self.SOURCE])
+        return self._item(entry)
+
+    def dedupe(self):
+        """Drop later copies of songs that are queued more than once. Returns how many."""
+        duplicated = {song_id for song_id, count in self._ids.items() if song_id is not None and count > 1}
+        if not duplicated:
+            return 0
+        seen = set()
+        removed = 0
+        for entry in sorted(entry for entry in self._heap if entry[self.ALIVE]):
+            song_id = self._song_id(entry[self.SOURCE])
+            if song_id not in duplicated:
+                continue
+            if song_id in seen:
+                self._kill(entry)
+                removed += 1
+            seen.add(song_id)
+        return removed
+
+    def clear(self):
+        """Remove every queued song. Whoever is waiting in get() keeps waiting."""
+        removed = self._live
+        self._heap = []
+        self._live = 0
+        self._ids.clear()
+        self.scheduler.reset()
+        self._changed()
+        return removed
@@ -0,0 +1,153 @@
+import collections
+import random
+import time
+
+
+class SongSampler:
+    """Random songs from the library for auto() and !pl <n>.
+
+    Keeps a flat array of every song id that follows the library's changes,
+    so drawing k songs costs O(k) instead of copying and shuffling the whole
+    library. Songs a guild played recently are skipped, and with a `weight`
+    function (song id -> weight) songs can be drawn by play count or
+    recency using an alias table that is only rebuilt when the library
+    changes or every *weight_ttl* seconds, since weights drift as songs play.
+    Draws with replacement can keep hitting the same heavy songs; whatever
+    is still missing then comes from one weighted pass without replacement,
+    so sample() always returns min(k, len(library)) songs.
+    """
+
+    def __init__(self, library, *, recent=100, weight_ttl=600):
+        self.library = library
+        self.recent = recent
+        self.weight = None
+        self.weight_ttl = weight_ttl
+        self._alias_at = 0.0
+        self._ids = []
+        self._pos = {}
+        self._alias = None
+        self._played = collections.defaultdict(self._history)
+
+    def _history(self):
+        return collections.deque(maxlen=self.recent), set()
+
+    def load(self):
+        self._ids = self.library.ids()
+        self._pos = {song_id: i for i, song_id in enumerate(self._ids)}
+        self._alias = None
+        self.library.listeners.append(self._changed)
+        return self
+
+    def _changed(self, op, song_id, song):
+        if op == 'add' and song_id not in self._pos:
+            self._pos[song_id] = len(self._ids)
+            self._ids.append(song_id)
+            self._alias = None
+        elif op == 'remove' and song_id in self._pos:
+            # 跟最後一個交換再刪掉，O(1)
+            i = self._pos.pop(song_id)
+            last = self._ids.pop()
+            if last != song_id:
+                self._ids[i] = last
+                self._pos[last] = i
+            self._alias = None
+
+    def reweight(self):
+        """Call when the weights changed; the alias table is rebuilt on the next draw."""
+        self._alias = None
+
+    def played(self, guild_id, song_id):
+        """Remember that *guild_id* just played *song_id*."""
+        order, seen = self._played[guild_id]
+        if song_id in seen:
+            return
+        if len(order) == order.maxlen:
+            seen.discard(order[0])
+        order.append(song_id)
+        seen.add(song_id)
+
+    def _build_alias(self):
+        # Vose's alias method: 建表 O(n)，之後每抽一次 O(1)
+        n = len(self._ids)
+        weights = [max(self.weight(song_id), 0.0) for song_id in self._ids]
+        total = sum(weights) or 1.0
+        scaled = [w * n / total for w in weights]
+        prob = [0.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large:
+            prob[i] = 1.0
+        self._alias = prob, alias
+        self._alias_at = time.monotonic()
+
+    def _draw_weighted(self):
+        prob, alias = self._alias
+        i = random.randrange(len(prob))
+        return self._ids[i] if random.random() < prob[i] else self._ids[alias[i]]
+
+    def _draw(self):
+        return self._ids[random.randrange(len(self._ids))]
+
+    def _key(self, song_id):
+        # A-ES (Efraimidis-Spirakis): 照 key 由大到小取就是不放回的加權抽樣
+        weight = max(self.weight(song_id), 0.0)
+        return random.random() ** (1 / weight) if weight > 0 else 0.0
+
+    def sample(self, k, *, guild_id=None, weighted=False, exclude=None):
+        """Draw up to *k* distinct songs.
+
+        Skips songs *guild_id* played recently and song ids for which
+        *exclude* returns True, unless there aren't enough other songs.
+        """
+        n = len(self._ids)
+        k = min(k, n)
+        if k == 0:
+            return []
+        weighted = weighted and self.weight is not None
+        if weighted and (self._alias is None or time.monotonic() - self._alias_at > self.weight_ttl):
+            self._build_alias()
+        if not weighted and k > n // 2:
+            # 要抽一大半的話直接洗牌比較快
+            candidates = random.sample(self._ids, n)
+        else:
+            draw = self._draw_weighted if weighted else self._draw
+            candidates = (draw() for _ in range(4 * k + 32))
+        recent = self._played[guild_id][1] if guild_id is not None else ()
+        chosen = []
+        spare = []
+        seen = set()
+        for song_id in candidates:
+            if song_id in seen:
+                continue
+            seen.add(song_id)
+            if song_id in recent or (exclude is not None and exclude(song_id)):
+                spare.append(song_id)
+                continue
+            chosen.append(song_id)
+            if len(chosen) == k:
+                break
+        if len(chosen) < k and len(seen) < n:
+            # 抽到太多重複的，剩下的歌不放回地抽完
+            rest = [song_id for song_id in self._ids if song_id not in seen]
+            if weighted:
+                rest.sort(key=self._key, reverse=True)
+            else:
+                random.shuffle(rest)
+            for song_id in rest:
+                if song_id in recent or (exclude is not None and exclude(song_id)):
+                    spare.append(song_id)
+                    continue
+                chosen.append(song_id)
+                if len(chosen) == k:
+                    break
+        # 不夠的話就不管最近播過了
+        chosen += spare[:k - len(chosen)]
+        songs = [self.library.get(song_id) for song_id in chosen]
+        return [song for song in songs if song is not None]
@@ -0,0 +1,143 @@
+import json
+
+from writebehind import WriteBehind
+
+
+class PlayerStore:
+    """Every guild's queue, current song and volume, kept on disk across restarts.
+
+    Players call touch() when something changed. A background write a few
+    seconds later encodes only the touched guilds again and writes the
+    file, so one guild skipping a song doesn't re-encode everyone's queue.
+    Songs that are in the custom playlist are stored as their id, which
+    keeps long queues small.
+
+    After a restart the saved guilds wait in `saved`, still as JSON text,
+    until their player is back in a voice channel and take()s them. Players
+    that lose their voice connection are suspend()ed the same way, so an
+    idle guild costs a string instead of a player with its task and queue.
+    """
+
+    def __init__(self, path, library, *, delay=5.0):
+        self.path = path
+        self.library = library
+        self.delay = delay
+        self.saved = {}  # guild id -> JSON text of a state that hasn't been restored yet
+        self._encoded = {}  # guild id -> JSON text
+        self._players = {}  # guild id -> callable returning the current state
+        self._dirty = set()
+        self._saver = WriteBehind(path, self._collect, delay=delay)
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf8') as f:
+                data = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            data = {}
+        for guild_id, state in data.items():
+            encoded = json.dumps(state, ensure_ascii=False, separators=(',', ':'))
+            self.saved[int(guild_id)] = self._encoded[int(guild_id)] = encoded
+        return self
+
+    # ------------------------------------------------------------------
+    # songs <-> compact form
+
+    def _encode_item(self, priority, timestamp, owner, source):
+        song_id = source.get('id')
+        if song_id is not None and song_id in self.library:
+            return [priority, timestamp, owner, song_id, source.get('requester')]
+        return [priority, timestamp, owner, {key: source[key] for key in
+                                             ('id', 'title', 'webpage_url', 'url', 'file_url', 'requester')
+                                             if source.get(key) is not None}]
+
+    def _decode_item(self, item):
+        if len(item) == 5:
+            priority, timestamp, owner, song_id, requester = item
+            source = self.library.get(song_id)
+            if source is None:
+                # 已經從歌單刪掉了
+                return None
+            if requester is not None:
+                source['requester'] = requester
+        else:
+            priority, timestamp, owner, source = item
+        return priority, timestamp, owner, source
+
+    def encode(self, state):
+        if state is None:
+            return None
+        return json.dumps({
+            'volume': state['volume'],
+            'scheduler': state['scheduler'],
+            'queue': [self._encode_item(*item) for item in state['queue']],
+        }, ensure_ascii=False, separators=(',', ':'))
+
+    # ------------------------------------------------------------------
+    # players
+
+    def attach(self, guild_id, state):
+        """Save *state()* for this guild whenever it is touched."""
+        self._players[guild_id] = state
+
+    def detach(self, guild_id):
+        """The player is gone for good (!stop, idle): forget its state."""
+        self._players.pop(guild_id, None)
+        self._dirty.discard(guild_id)
+        self.saved.pop(guild_id, None)
+        if self._encoded.pop(guild_id, None) is not None:
+            self._saver.changed()
+
+    def suspend(self, guild_id):
+        """The player is going away for now: keep its state until take() brings it back."""
+        state = self._players.pop(guild_id, None)
+        self._dirty.discard(guild_id)
+        encoded = self.encode(state()) if state is not None else None
+        if encoded is None:
+            self._encoded.pop(guild_id, None)
+        else:
+            self.saved[guild_id] = self._encoded[guild_id] = encoded
+        self._saver.changed()
+
+    def touch(self, guild_id):
+        self._dirty.add(guild_id)
+        self._saver.changed()
+
+    def take(self, guild_id):
+        """The saved state of *guild_id* with its queue decoded, or None. Only once."""
+        encoded = self.saved.pop(guild_id, None)
+        if encoded is None:
+            return None
+        state = json.loads(encoded)
+        items = (self._decode_item(item) for item in state['queue'])
+        return dict(state, queue=[item for item in items if item is not None])
+
+    def saved_songs(self, count):
+        """The first *count* songs of every saved queue, to download ahead of time."""
+        for encoded in list(self.saved.values()):
+            for item in json.loads(encoded)['queue'][:count]:
+                item = self._decode_item(item)
+                if item is not None:
+                    yield item[3]
+
+    # ------------------------------------------------------------------
+    # writing
+
+    def _collect(self):
+        for guild_id in self._dirty:
+            # 還沒恢復的伺服器，存的東西比現在這個空的 player 重要
+            if guild_id in self.saved or guild_id not in self._players:
+                continue
+            encoded = self.encode(self._players[guild_id]())
+            if encoded is None:
+                self._encoded.pop(guild_id, None)
+            else:
+                self._encoded[guild_id] = encoded
+        self._dirty.clear()
+        return '{' + ','.join(f'"{guild_id}":{encoded}' for guild_id, encoded in self._encoded.items()) + '}'
+
+    def close(self):
+        """Save every player as it is now. Used on shutdown."""
+        if self._players:
+            self._dirty.update(self._players)
+            self._saver.dirty = True
+        self._saver.close()
@@ -0,0 +1,25 @@
+from cache import AudioCache
+
+
+def test_load_skips_and_removes_partial_files(tmp_path):
+    for name in ('youtube-a.webm', 'youtube-b.webm.part', 'youtube-c.webm.123-0.tmp', 'youtube-a.v10.opus.tmp',
+                 'index.json.tmp'):
+        (tmp_path / name).write_bytes(b'x' * 10)
+    cache = AudioCache(str(tmp_path), budget=1000).load()
+    assert list(cache.entries) == [str(tmp_path / 'youtube-a.webm')]
+    assert cache.total == 10
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['youtube-a.webm']
+
+
+def test_find_knows_only_this_folder_and_skips_variants(tmp_path):
+    for name in ('youtube-a.webm', 'youtube-a.v10.opus', 'youtube-b.v20.opus'):
+        (tmp_path / name).write_bytes(b'x')
+    cache = AudioCache(str(tmp_path), budget=1000).load()
+    assert cache.find('a') == str(tmp_path / 'youtube-a.webm')
+    # 只有轉好的 Opus 版本不算下載過
+    assert cache.find('b') is None
+    cache.add(str(tmp_path / 'youtube-b.v20.opus'), 'b')
+    assert cache.find('b') is None
+    (tmp_path / 'youtube-c.webm').write_bytes(b'x')
+    cache.add(str(tmp_path / 'youtube-c.webm'), 'c')
+    assert cache.find('c') == str(tmp_path / 'youtube-c.webm')
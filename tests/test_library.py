@@ -0,0 +1,39 @@
+import asyncio
+import glob
+import sqlite3
+import time
+
+from library import SongLibrary, SqliteLibrary
+
+
+def test_flush_writes_song_json_and_drops_the_journal(tmp_path):
+    path = str(tmp_path / 'song.json')
+    library = SongLibrary(path).load()
+    library.add('a', {'title': 'A'})
+    library.add('b', {'title': 'B'})
+    asyncio.new_event_loop().run_until_complete(library.flush())
+    # 已經寫進 song.json 的 journal 段刪掉，只剩新開的那一段
+    assert glob.glob(path + '.journal.*') == [path + '.journal.1']
+    library.update('a', title='A2')
+    library.close()
+
+    again = SongLibrary(path).load()
+    assert again.get('a')['title'] == 'A2' and again.ids() == ['a', 'b']
+    again.close()
+    assert glob.glob(path + '.journal.*') == []
+
+
+def test_sqlite_writes_do_not_wait_for_the_write_lock(tmp_path):
+    path = str(tmp_path / 'song.db')
+    library = SqliteLibrary(path).load()
+    # 另一個 worker 拿著寫入鎖
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    start = time.perf_counter()
+    assert library.add('a', {'title': 'A'})
+    assert time.perf_counter() - start < 0.5
+    other.execute('COMMIT')
+    other.close()
+    asyncio.new_event_loop().run_until_complete(library.flush())
+    assert library.get('a')['title'] == 'A' and len(library) == 1
+    library.close()
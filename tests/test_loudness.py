@@ -0,0 +1,24 @@
+import pytest
+
+from loudness import OpusVariants
+
+
+@pytest.mark.parametrize('volume, level', [(0.1, 10), (0.12, 14), (0.004, 1), (-0.1, 1), (1.0, 100), (5.0, 200)])
+def test_step_is_the_nearest_level(volume, level):
+    assert OpusVariants.step(volume) == level
+
+
+def test_every_volume_maps_to_a_few_levels():
+    steps = {OpusVariants.step(percent / 100) for percent in range(1, 201)}
+    assert steps <= set(OpusVariants.LEVELS)
+
+
+def test_no_more_variants_than_the_limit(tmp_path):
+    file_url = str(tmp_path / 'youtube-abc.webm')
+    variants = OpusVariants(limit=2)
+    for volume in (0.1, 0.5):
+        with open(variants.path(file_url, volume), 'wb'):
+            pass
+    assert variants.variants(file_url) == 2
+    variants.submit(file_url, 0.0, 0.3)
+    assert not variants._pending
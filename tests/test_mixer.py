@@ -0,0 +1,26 @@
+import io
+
+import discord
+
+from mixer import FRAME_BYTES, Mixer
+
+
+class Song(discord.PCMVolumeTransformer):
+    def __init__(self, frames):
+        super().__init__(discord.PCMAudio(io.BytesIO(b'\1' * FRAME_BYTES * frames)))
+
+
+class OpusSong(discord.AudioSource):
+    def read(self):
+        return b''
+
+    def is_opus(self):
+        return True
+
+
+def test_stage_refuses_opus_sources():
+    mixer = Mixer(Song(3), buffer=2, crossfade=0)
+    # Opus 封包沒辦法跟 PCM 混，要留給 player 自己播
+    assert not mixer.stage(OpusSong())
+    assert mixer.next is None
+    assert mixer.stage(Song(1))
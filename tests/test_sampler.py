@@ -0,0 +1,37 @@
+import pytest
+
+from library import open_library
+from sampler import SongSampler
+
+
+def make_sampler(tmp_path, n):
+    library = open_library(str(tmp_path / 'song.json'))
+    for i in range(n):
+        library.add(f'song{i}', {'title': f'song {i}', 'url': f'song {i}'})
+    sampler = SongSampler(library).load()
+    # 少數幾首歌的權重大很多，重複抽到的機會很高
+    sampler.weight = lambda song_id: 1000.0 if int(song_id[4:]) < 5 else 1.0 + int(song_id[4:]) % 3
+    return library, sampler
+
+
+@pytest.mark.parametrize('n, k', [(120, 100), (150, 100), (30, 100), (1000, 10)])
+def test_weighted_sample_returns_min_k_n(tmp_path, n, k):
+    library, sampler = make_sampler(tmp_path, n)
+    try:
+        for _ in range(20):
+            songs = sampler.sample(k, weighted=True)
+            assert len(songs) == min(k, n)
+            assert len({song['id'] for song in songs}) == len(songs)
+    finally:
+        library.close()
+
+
+def test_weighted_sample_with_recent_and_exclude(tmp_path):
+    library, sampler = make_sampler(tmp_path, 120)
+    try:
+        for i in range(50):
+            sampler.played(1, f'song{i}')
+        songs = sampler.sample(100, guild_id=1, weighted=True, exclude=lambda song_id: song_id == 'song60')
+        assert len(songs) == 100
+    finally:
+        library.close()
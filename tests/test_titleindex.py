@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from library import open_library
+from titleindex import TitleIndex
+
+SONGS = {
+    'YQHsXMglC9A': 'Adele - Hello',
+    'DYptgVvkVLQ': '周杰倫 晴天',
+    'fJ9rUzIMcZQ': 'Queen - Bohemian Rhapsody',
+}
+
+
+def settle(library):
+    # song.db 的寫入在另一個 thread，等寫完、listener 都收到
+    asyncio.new_event_loop().run_until_complete(library.flush())
+
+
+@pytest.fixture(params=['song.json', 'song.db'])
+def library(request, tmp_path):
+    library = open_library(str(tmp_path / request.param))
+    for song_id, title in SONGS.items():
+        library.add(song_id, {'title': title, 'url': f'https://youtu.be/{song_id}'})
+    settle(library)
+    yield library
+    library.close()
+
+
+@pytest.fixture
+def index(library):
+    return TitleIndex(library).load()
+
+
+@pytest.mark.parametrize('query', ['lo', 'he', '天', '晴天', 'Q'])
+def test_short_query_has_no_exact_match(index, query):
+    # !pl remove 只會刪 exact() 找到的歌，所以這些都不會刪到任何一首
+    assert index.exact(query) is None
+
+
+def test_exact_title_or_id(index):
+    assert index.exact('adele - hello') == 'YQHsXMglC9A'
+    assert index.exact('周杰倫 晴天') == 'DYptgVvkVLQ'
+    assert index.exact('fJ9rUzIMcZQ') == 'fJ9rUzIMcZQ'
+    assert index.exact('Adele') is None
+
+
+def test_short_substring_is_not_a_strong_match(index):
+    assert index.best('lo', threshold=0.8) is None
+    assert index.search('Bohemian Rhap', 1)[0][1] == 'fJ9rUzIMcZQ'
+
+
+def test_version_only_follows_titles_and_order(library, index):
+    version = index.version
+    library.update('YQHsXMglC9A', file_url='downloads/youtube-YQHsXMglC9A.webm')
+    settle(library)
+    assert index.version == version
+    library.update('YQHsXMglC9A', title='Adele - Hello (Live)')
+    library.add('kJQP7kiw5Fk', {'title': 'Despacito'})
+    library.remove('DYptgVvkVLQ')
+    settle(library)
+    assert index.version == version + 3
+    assert [title for _, title in library.titles(1, 10)] == ['Adele - Hello (Live)', 'Queen - Bohemian Rhapsody',
+                                                             'Despacito']
+    assert index.exact('adele - hello (live)') == 'YQHsXMglC9A'
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import threading
+
+from history import PlayHistory
+from writebehind import WriteBehind
+
+
+def test_close_waits_for_the_write_in_progress(tmp_path):
+    path = str(tmp_path / 'state.json')
+    started, release = threading.Event(), threading.Event()
+    state = {'n': 1}
+    writes = []
+
+    def write(data):
+        writes.append(data)
+        if len(writes) == 1:
+            started.set()
+            release.wait(5)
+        with open(path, 'w') as f:
+            f.write(data)
+
+    saver = WriteBehind(path, lambda: json.dumps(state), delay=0, write=write)
+
+    async def run():
+        saver.changed()
+        await asyncio.sleep(0.01)
+        assert started.wait(5)
+        state['n'] = 2
+        saver.changed()
+        await asyncio.sleep(0.01)
+
+    asyncio.new_event_loop().run_until_complete(run())
+    threading.Timer(0.05, release.set).start()
+    saver.close()
+    # 第二次等第一次寫完才寫，最後的檔案是新的
+    assert writes == ['{"n": 1}', '{"n": 2}']
+    with open(path) as f:
+        assert json.load(f) == {'n': 2}
+
+
+def test_failed_write_is_retried_on_close(tmp_path):
+    path = str(tmp_path / 'state.json')
+    calls = []
+
+    def write(data):
+        calls.append(data)
+        if len(calls) == 1:
+            raise OSError('disk full')
+        with open(path, 'w') as f:
+            f.write(data)
+
+    saver = WriteBehind(path, lambda: 'x', delay=0, write=write)
+
+    async def run():
+        saver.changed()
+        await asyncio.sleep(0.05)
+
+    asyncio.new_event_loop().run_until_complete(run())
+    saver.close()
+    assert calls == ['x', 'x']
+
+
+def test_history_log_and_offset_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'history.jsonl')
+    history = PlayHistory(path)
+    for song in ('a', 'b', 'a'):
+        history.end(history.start(1, song, song.upper(), '我'))
+    history.close()
+    again = PlayHistory(path).load()
+    assert again.total == 3 and again.tracks['a'] == 2
+    with open(path + '.stats') as f:
+        assert json.load(f)['offset'] == (tmp_path / 'history.jsonl').stat().st_size
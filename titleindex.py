@@ -0,0 +1,136 @@
+import collections
+import heapq
+import math
+import re
+import unicodedata
+
+# 中日韓文字沒有空白分詞，一個字一個字切
+CJK = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+WORD = re.compile(r'[^\W_]+')
+# 比這短的字串出現在標題裡不算什麼 ('lo' 在 Hello 裡)，只照它佔標題多少給分
+SUBSTRING_MIN = 4
+
+
+class TitleIndex:
+    """Fuzzy title search over the library for !pl find / play / remove.
+
+    Titles are normalized (NFKC, case folded) and cut into n-grams: single
+    characters and pairs for CJK text, whole words and trigrams for
+    everything else. A search scores every song that shares a gram with the
+    query by the rarity of the grams it matches, so results come back in
+    milliseconds without asking YouTube.
+
+    `version` goes up when a song is added or removed or its title changes,
+    not when other fields like file_url do, so it can key anything built
+    from titles and positions.
+    """
+
+    def __init__(self, library):
+        self.library = library
+        self._postings = collections.defaultdict(set)
+        self._grams = {}
+        self._titles = {}
+        self.version = 0
+
+    @staticmethod
+    def normalize(text):
+        return unicodedata.normalize('NFKC', text).casefold()
+
+    @classmethod
+    def grams(cls, text):
+        text = cls.normalize(text)
+        grams = set()
+        for run in CJK.findall(text):
+            grams.update(run)
+            grams.update(run[i:i + 2] for i in range(len(run) - 1))
+        for word in WORD.findall(CJK.sub(' ', text)):
+            grams.add(word)
+            padded = f' {word} '
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return grams
+
+    def load(self):
+        for song_id, song in self.library.items():
+            self._add(song_id, song['title'])
+        self.library.listeners.append(self._changed)
+        return self
+
+    def _changed(self, op, song_id, song):
+        if op == 'update' and self._titles.get(song_id) == song['title']:
+            # 只是下載的檔案之類的欄位變了
+            return
+        self.version += 1
+        if op != 'add':
+            self._remove(song_id)
+        if op != 'remove':
+            self._add(song_id, song['title'])
+
+    def _add(self, song_id, title):
+        grams = self.grams(title)
+        self._grams[song_id] = grams
+        self._titles[song_id] = title
+        for gram in grams:
+            self._postings[gram].add(song_id)
+
+    def _remove(self, song_id):
+        for gram in self._grams.pop(song_id, ()):
+            posting = self._postings[gram]
+            posting.discard(song_id)
+            if not posting:
+                del self._postings[gram]
+        self._titles.pop(song_id, None)
+
+    def search(self, text, limit=10):
+        """Best matches for *text* as (score, song id, title), best first.
+
+        The score is between 0 and 1; 1 means every part of the query matched.
+        """
+        query = self.grams(text)
+        total = len(self._grams) or 1
+        weights = {gram: math.log(1 + total / len(self._postings[gram])) for gram in query if gram in self._postings}
+        if not weights:
+            return []
+        # 沒配對到的字也要算在分母，不然亂打的字也會拿滿分
+        possible = sum(weights.values()) + math.log(1 + total) * (len(query) - len(weights))
+        scores = collections.Counter()
+        for gram, weight in weights.items():
+            for song_id in self._postings[gram]:
+                scores[song_id] += weight
+        needle = self.normalize(text).strip()
+        ranked = []
+        for song_id, score in scores.items():
+            title = self._titles[song_id]
+            score /= possible
+            normalized = self.normalize(title)
+            if needle and needle in normalized:
+                score = max(score, 0.99 if len(needle) >= SUBSTRING_MIN else len(needle) / len(normalized))
+            # 同分的話標題短的比較像
+            ranked.append((score, -len(title), song_id))
+        best = heapq.nlargest(limit, ranked)
+        return [(round(score, 3), song_id, self._titles[song_id]) for score, _, song_id in best]
+
+    def exact(self, text):
+        """The id of the song whose id or title is exactly *text*, or None.
+
+        Used for !pl remove: deleting from the shared library must never
+        happen on a fuzzy match, those are only offered as suggestions.
+        """
+        text = text.strip()
+        if text in self._titles:
+            return text
+        grams = self.grams(text)
+        if not grams:
+            return None
+        # 標題一樣的話 gram 也一樣，只要比對其中一個 gram 的歌
+        needle = self.normalize(text)
+        for song_id in self._postings.get(next(iter(grams)), ()):
+            if self.normalize(self._titles[song_id]) == needle:
+                return song_id
+        return None
+
+    def best(self, text, threshold=0.5):
+        """The single best match, or None if nothing scores at least *threshold*."""
+        found = self.search(text, 1)
+        if found and found[0][0] >= threshold:
+            return found[0]
+        return None
@@ -0,0 +1,96 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# 同一個檔案一次只有一個寫入，兩個 thread 只是不要讓大檔案卡住小檔案
+_executor = ThreadPoolExecutor(2, thread_name_prefix='write-behind')
+
+
+def replace_file(path, data):
+    """Write *data* to *path* through a temporary file, so a crash leaves the old file."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf8') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class WriteBehind:
+    """Writes *path* in a background thread a while after it changed.
+
+    Call changed() whenever the data changed. *delay* seconds later *encode*
+    is called on the event loop for the text to write, and the text goes to
+    disk through a temporary file in a thread. A write only starts after the
+    previous one finished, and a failed write is logged and done again by
+    the next change or close(). Without a running event loop nothing is
+    scheduled and close() writes it all.
+
+    *write* replaces the plain replace_file() for files that need more than
+    one text, it gets whatever *encode* returned.
+    """
+
+    def __init__(self, path, encode, *, delay=30, write=None):
+        self.path = path
+        self.encode = encode
+        self.delay = delay
+        self.write = write or (lambda data: replace_file(path, data))
+        self.dirty = False
+        self._handle = None
+        self._future = None
+
+    def changed(self):
+        self.dirty = True
+        if self._handle is None:
+            try:
+                loop = asyncio.get_event_loop()
+            except RuntimeError:
+                return
+            self._handle = loop.call_later(self.delay, self._start, loop)
+
+    def _start(self, loop):
+        if self._future is not None and not self._future.done():
+            # 上一次還沒寫完，晚一點再來，不然舊的可能蓋掉新的
+            self._handle = loop.call_later(self.delay, self._start, loop)
+            return
+        self._handle = None
+        self._submit()
+
+    def _submit(self):
+        self.dirty = False
+        self._future = _executor.submit(self.write, self.encode())
+        self._future.add_done_callback(self._done)
+        return self._future
+
+    def _done(self, future):
+        error = future.exception()
+        if error is not None:
+            print(f'could not save {self.path}: {error}')
+            # 下次有變動或 close() 的時候再寫
+            self.dirty = True
+
+    async def flush(self):
+        """Write now if anything changed and wait until it is on disk."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        # 例外 _done 會印，這裡不用再丟出去
+        if self._future is not None and not self._future.done():
+            await asyncio.wait([asyncio.wrap_future(self._future)])
+        if self.dirty:
+            await asyncio.wait([asyncio.wrap_future(self._submit())])
+
+    def close(self):
+        """Wait for the write in progress, then write what changed since. Used on shutdown."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._future is not None:
+            # 例外 _done 會印，這裡只要等它寫完
+            if self._future.exception() is not None:
+                self.dirty = True
+            self._future = None
+        if self.dirty:
+            self.dirty = False
+            self.write(self.encode())